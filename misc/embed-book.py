@@ -1,6 +1,15 @@
 import fitz  # PyMuPDF
 import re
-from typing import List, Dict, Any
+import os
+import json
+import time
+import random
+import argparse
+import unicodedata
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Dict, Any, Iterator, Tuple, Set
 from sentence_transformers import SentenceTransformer
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from supabase import create_client, Client
@@ -29,8 +38,23 @@ MARGIN_BOTTOM = 28
 MARGIN_LEFT = 70
 MARGIN_RIGHT = 35
 
+# Chunking
+CHUNK_SIZE = 600
+CHUNK_OVERLAP = 100
+
 # Embedding Model
 MODEL_NAME = 'all-MiniLM-L6-v2'  # Produces 384-dimensional vectors
+
+# Pipeline
+PAGES_PER_TASK = 20          # Pages per extraction task
+EXTRACT_WORKERS = os.cpu_count() or 2
+EMBED_BATCH_SIZE = 64        # Texts per model forward pass
+UPLOAD_BATCH_SIZE = 50       # Rows per Supabase upsert / delete
+UPLOAD_CONCURRENCY = 4       # Requests in flight at once
+MAX_RETRIES = 5              # Per upload batch, with exponential backoff
+RETRY_BASE_DELAY = 1.0       # Seconds
+MANIFEST_PATH = PDF_PATH + ".manifest.json"
+
 # ==========================================
 # 2. HELPER CLASSES
 # ==========================================
@@ -39,8 +63,67 @@ class ProcessedChunk:
     def __init__(self, text: str, page_num: int):
         self.text = text
         self.page_num = page_num
+        self.fingerprint = chunk_fingerprint(PDF_PATH, page_num, text, MODEL_NAME)
         self.vector = []
 
+
+class Manifest:
+    """
+    Local record of the chunk fingerprints currently stored in Supabase for
+    this book (fingerprint -> page number).
+
+    A rerun diffs the freshly extracted chunks against it: only fingerprints
+    that are missing get embedded and upserted, and fingerprints that no
+    longer occur are deleted. It is updated after every successful batch, so
+    an interrupted run picks up where it stopped.
+
+    legacy_cleaned records that this book's pre-fingerprint rows have been
+    deleted. It is only set once a run finishes that cleanup; the file existing
+    says nothing, since it is written after the first batch.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fingerprints: Dict[str, int] = {}
+        self.legacy_cleaned = False
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("course_id") == COURSE_ID and data.get("table") == TABLE_NAME:
+                self.fingerprints = data.get("fingerprints", {})
+                self.legacy_cleaned = bool(data.get("legacy_cleaned", False))
+            else:
+                print("⚠️ Manifest was written for another course/table; starting from an empty one.")
+
+    def add(self, entries: Dict[str, int]):
+        with self._lock:
+            self.fingerprints.update(entries)
+            self._save()
+
+    def remove(self, fingerprints: List[str]):
+        with self._lock:
+            for fp in fingerprints:
+                self.fingerprints.pop(fp, None)
+            self._save()
+
+    def mark_legacy_cleaned(self):
+        with self._lock:
+            self.legacy_cleaned = True
+            self._save()
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "course_id": COURSE_ID,
+                "table": TABLE_NAME,
+                "source": PDF_PATH,
+                "legacy_cleaned": self.legacy_cleaned,
+                "fingerprints": self.fingerprints,
+            }, f)
+        os.replace(tmp, self.path)
+
 # ==========================================
 # 3. FUNCTIONS
 # ==========================================
@@ -51,30 +134,50 @@ def clean_text_artifacts(text: str) -> str:
     text = re.sub(r'^\s*\d+\s*$', '', text, flags=re.MULTILINE)
     return text.strip()
 
-def process_and_chunk_book() -> List[ProcessedChunk]:
-    """
-    Loops through the PDF page by page, cleans text, chunks it,
-    and assigns the correct book page number.
-    """
-    print(f"📖 Opening PDF: {PDF_PATH}...")
-    doc = fitz.open(PDF_PATH)
 
-    end_index = END_PDF_PAGE if END_PDF_PAGE is not None else len(doc)
+def chunk_fingerprint(source: str, page_num: int, text: str, model_name: str) -> str:
+    """sha256 over (source, page, normalized text, model): changes iff the stored row would."""
+    normalized = " ".join(unicodedata.normalize("NFC", text).split())
+    h = hashlib.sha256()
+    for part in (source, str(page_num), model_name, normalized):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def page_ranges() -> List[Tuple[int, int]]:
+    """Split the selected PDF pages into [start, end) ranges of PAGES_PER_TASK."""
+    with fitz.open(PDF_PATH) as doc:
+        end_index = END_PDF_PAGE if END_PDF_PAGE is not None else len(doc)
+    return [
+        (start, min(start + PAGES_PER_TASK, end_index))
+        for start in range(START_PDF_PAGE, end_index, PAGES_PER_TASK)
+    ]
+
+
+# Per-process state for extraction workers (fitz documents can't be pickled)
+_worker_doc = None
+_worker_splitter = None
+
 
-    # Initialize Splitter
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=600,
-        chunk_overlap=100,
+def _init_extract_worker():
+    global _worker_doc, _worker_splitter
+    _worker_doc = fitz.open(PDF_PATH)
+    _worker_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
         separators=["\n\n", "\n", ". ", " ", ""]
     )
 
-    all_processed_chunks = []
 
-    print(f"⚙️ Processing pages {START_PDF_PAGE} to {end_index}...")
-
-    # Loop through the selected PDF pages
-    for i in range(START_PDF_PAGE, end_index):
-        page = doc[i]
+def extract_range(page_range: Tuple[int, int]) -> List[Tuple[str, int]]:
+    """
+    Runs in a worker process: crops, cleans and chunks each page of the range.
+    Returns (chunk_text, book_page_number) pairs.
+    """
+    out = []
+    for i in range(*page_range):
+        page = _worker_doc[i]
 
         # Calculate the "Human" page number (e.g., Page 1, Page 2...)
         # Logic: If we are on the 0th processed page, it is FIRST_BOOK_PAGE_NUM
@@ -97,82 +200,245 @@ def process_and_chunk_book() -> List[ProcessedChunk]:
 
         # 3. Chunk THIS page only
         # (This ensures the page metadata is accurate for these specific chunks)
-        page_chunks = text_splitter.split_text(cleaned_text)
-
-        # 4. Create objects
-        for chunk_text in page_chunks:
-            all_processed_chunks.append(
-                ProcessedChunk(text=chunk_text, page_num=current_book_page)
-            )
-
-        if i % 20 == 0:
-            print(f"   Processed PDF page {i} (Book Page {current_book_page})...")
-
-    doc.close()
-    print(f"✅ Extracted {len(all_processed_chunks)} total text chunks.")
-    return all_processed_chunks
+        for chunk_text in _worker_splitter.split_text(cleaned_text):
+            out.append((chunk_text, current_book_page))
+    return out
 
-def generate_embeddings(chunks: List[ProcessedChunk]):
-    """Generates vectors for the list of chunk objects."""
-    print(f"🧠 Loading model '{MODEL_NAME}'...")
-    model = SentenceTransformer(MODEL_NAME)
 
+def iter_page_chunks(ranges: List[Tuple[int, int]]) -> Iterator[Tuple[Tuple[int, int], List[ProcessedChunk]]]:
+    """
+    Extracts ranges in a process pool and yields (range, chunks) as they finish.
+    At most 2 * EXTRACT_WORKERS ranges are in flight, so memory stays flat
+    no matter how long the book is.
+    """
+    pending = {}
+    todo = iter(ranges)
+    with ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, initializer=_init_extract_worker) as pool:
+        while True:
+            while len(pending) < 2 * EXTRACT_WORKERS:
+                page_range = next(todo, None)
+                if page_range is None:
+                    break
+                pending[pool.submit(extract_range, page_range)] = page_range
+            if not pending:
+                return
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                page_range = pending.pop(fut)
+                chunks = [ProcessedChunk(text=t, page_num=p) for t, p in fut.result()]
+                yield page_range, chunks
+
+
+def generate_embeddings(model: SentenceTransformer, chunks: List[ProcessedChunk]):
+    """Generates vectors for the list of chunk objects in fixed-size batches."""
     # Extract just the text strings for the model
     text_list = [c.text for c in chunks]
-
-    print(f"⚡ Generating embeddings...")
-    vectors = model.encode(text_list, show_progress_bar=True).tolist()
+    vectors = model.encode(text_list, batch_size=EMBED_BATCH_SIZE, show_progress_bar=False).tolist()
 
     # Assign vectors back to the objects
     for chunk, vector in zip(chunks, vectors):
         chunk.vector = vector
 
-def upload_to_supabase(chunks: List[ProcessedChunk]):
-    """Uploads data including the new Page Number metadata."""
-    print("🚀 Connecting to Supabase...")
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-    data_payload = []
-
-    for chunk in chunks:
-        data_payload.append({
+def to_rows(chunks: List[ProcessedChunk]) -> List[Dict[str, Any]]:
+    return [
+        {
             "course_id": COURSE_ID,
             "chunk_text": chunk.text,
             "vector_data": chunk.vector,
             "metadata": {
                 "source": PDF_PATH,
-                "page_number": chunk.page_num  # <--- HERE IS YOUR METADATA
+                "page_number": chunk.page_num,  # <--- HERE IS YOUR METADATA
+                "fingerprint": chunk.fingerprint
             }
-        })
+        }
+        for chunk in chunks
+    ]
+
+
+_thread_local = threading.local()
 
-    batch_size = 50
-    total = len(data_payload)
-    print(f"   Uploading {total} records...")
 
-    for i in range(0, total, batch_size):
-        batch = data_payload[i : i + batch_size]
+def _supabase() -> Client:
+    # One client per upload thread
+    if not hasattr(_thread_local, "client"):
+        _thread_local.client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return _thread_local.client
+
+
+def with_retry(fn, label: str):
+    """Call fn(), retrying with exponential backoff + jitter. Raises after MAX_RETRIES."""
+    for attempt in range(MAX_RETRIES + 1):
         try:
-            supabase.table(TABLE_NAME).insert(batch).execute()
-            print(f"   Uploaded batch {i // batch_size + 1}")
+            return fn()
         except Exception as e:
-            print(f"❌ Error on batch {i}: {e}")
+            if attempt == MAX_RETRIES:
+                raise
+            delay = RETRY_BASE_DELAY * (2 ** attempt) + random.uniform(0, RETRY_BASE_DELAY)
+            print(f"   ⚠️ {label} failed ({e}); retry {attempt + 1}/{MAX_RETRIES} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def upsert_rows(rows: List[Dict[str, Any]]):
+    # Delete-then-insert keyed on the fingerprint: safe to retry, and needs no
+    # unique index on the JSON field for a real ON CONFLICT upsert.
+    fingerprints = [row["metadata"]["fingerprint"] for row in rows]
+    delete_rows(fingerprints)
+    _supabase().table(TABLE_NAME).insert(rows).execute()
+
+
+def delete_rows(fingerprints: List[str]):
+    (_supabase().table(TABLE_NAME).delete()
+        .eq("course_id", COURSE_ID)
+        .in_("metadata->>fingerprint", fingerprints)
+        .execute())
+
+
+def delete_legacy_rows():
+    """Rows from this book uploaded before fingerprints existed."""
+    (_supabase().table(TABLE_NAME).delete()
+        .eq("course_id", COURSE_ID)
+        .eq("metadata->>source", PDF_PATH)
+        .is_("metadata->>fingerprint", "null")
+        .execute())
+
+
+class Uploader:
+    """
+    Runs upserts/deletes as concurrent batches (bounded, so embedding can't run
+    far ahead) and records each successful batch in the manifest.
+    """
+
+    def __init__(self, manifest: Manifest):
+        self.manifest = manifest
+        self.pool = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY)
+        self.slots = threading.BoundedSemaphore(UPLOAD_CONCURRENCY * 2)
+        self.lock = threading.Lock()
+        self.upserted = 0
+        self.deleted = 0
+        self.failed_batches = 0
+
+    def _submit(self, fn, label: str, on_success):
+        # Blocks when too many batches are queued
+        self.slots.acquire()
+        fut = self.pool.submit(with_retry, fn, label)
+        fut.add_done_callback(lambda f: self._done(f, label, on_success))
+
+    def _done(self, fut, label: str, on_success):
+        self.slots.release()
+        error = fut.exception()
+        if error is not None:
+            print(f"❌ {label} gave up: {error}")
+            with self.lock:
+                self.failed_batches += 1
+            return
+        on_success()
+
+    def upsert(self, chunks: List[ProcessedChunk]):
+        for i in range(0, len(chunks), UPLOAD_BATCH_SIZE):
+            batch = chunks[i:i + UPLOAD_BATCH_SIZE]
+            rows = to_rows(batch)
+            entries = {c.fingerprint: c.page_num for c in batch}
+            label = f"upsert of {len(batch)} chunks (page {batch[0].page_num}+)"
+            self._submit(lambda rows=rows: upsert_rows(rows), label,
+                         lambda entries=entries: self._upserted(entries))
+
+    def delete(self, fingerprints: List[str]):
+        for i in range(0, len(fingerprints), UPLOAD_BATCH_SIZE):
+            batch = fingerprints[i:i + UPLOAD_BATCH_SIZE]
+            self._submit(lambda batch=batch: delete_rows(batch), f"delete of {len(batch)} stale chunks",
+                         lambda batch=batch: self._deleted(batch))
+
+    def _upserted(self, entries: Dict[str, int]):
+        self.manifest.add(entries)
+        with self.lock:
+            self.upserted += len(entries)
+
+    def _deleted(self, fingerprints: List[str]):
+        self.manifest.remove(fingerprints)
+        with self.lock:
+            self.deleted += len(fingerprints)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
 
 # ==========================================
 # 4. MAIN EXECUTION
 # ==========================================
 
 if __name__ == "__main__":
-    # 1. Process & Chunk (Page-by-Page)
-    chunk_objects = process_and_chunk_book()
+    parser = argparse.ArgumentParser(description="Embed a PDF book into Supabase, re-uploading only what changed.")
+    parser.add_argument("--dry-run", action="store_true", help="Extract and report the diff against the manifest; no embedding or upload")
+    parser.add_argument("--export", metavar="FILE", help="Embed every chunk into a JSONL file (rows shaped like the table) instead of Supabase; "
+                                                          "build a local index from it with server/vector_index.py")
+    args = parser.parse_args()
 
-    if not chunk_objects:
-        print("❌ No text found. Check your settings.")
+    print(f"📖 Opening PDF: {PDF_PATH}...")
+    if args.export:
+        print(f"🧠 Loading model '{MODEL_NAME}'...")
+        model = SentenceTransformer(MODEL_NAME)
+        written = 0
+        with open(args.export, "w", encoding="utf-8") as f:
+            seen: Set[str] = set()
+            for page_range, chunks in iter_page_chunks(page_ranges()):
+                chunks = [c for c in chunks if c.fingerprint not in seen]
+                seen.update(c.fingerprint for c in chunks)
+                if chunks:
+                    generate_embeddings(model, chunks)
+                for row in to_rows(chunks):
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                written += len(chunks)
+                print(f"   Processed PDF pages {page_range[0]}-{page_range[1]} ({len(chunks)} chunks)")
+        print(f"✅ Export Complete! {written} rows written to {args.export}")
         exit()
-
-    # 2. Embed
-    generate_embeddings(chunk_objects)
-
-    # 3. Upload
-    upload_to_supabase(chunk_objects)
-
-    print("✅ Ingestion Complete!")
+    manifest = Manifest(MANIFEST_PATH)
+    previous: Set[str] = set(manifest.fingerprints)
+
+    model = None
+    uploader = None
+    if not args.dry_run:
+        print(f"🧠 Loading model '{MODEL_NAME}'...")
+        model = SentenceTransformer(MODEL_NAME)
+        print("🚀 Connecting to Supabase...")
+        uploader = Uploader(manifest)
+
+    current: Dict[str, int] = {}
+    new_chunks = 0
+    try:
+        # 1. Extract (process pool) -> 2. Diff -> 3. Embed (fixed batches) -> 4. Upsert (bounded, concurrent)
+        for page_range, chunks in iter_page_chunks(page_ranges()):
+            fresh = []
+            for chunk in chunks:
+                if chunk.fingerprint in current:
+                    continue  # identical text repeated on the same page
+                current[chunk.fingerprint] = chunk.page_num
+                if chunk.fingerprint not in previous:
+                    fresh.append(chunk)
+            new_chunks += len(fresh)
+            if uploader is not None and fresh:
+                generate_embeddings(model, fresh)
+                uploader.upsert(fresh)
+            print(f"   Processed PDF pages {page_range[0]}-{page_range[1]} ({len(chunks)} chunks, {len(fresh)} new)")
+
+        stale = sorted(previous - set(current))
+        unchanged = len(current) - new_chunks
+        print(f"📊 Diff: {new_chunks} new/changed, {unchanged} unchanged, {len(stale)} stale.")
+        if not manifest.legacy_cleaned:
+            print("   Legacy cleanup pending: rows for this book without a fingerprint will be replaced.")
+
+        if uploader is not None:
+            uploader.delete(stale)
+            if not manifest.legacy_cleaned:
+                with_retry(delete_legacy_rows, "legacy row cleanup")
+                manifest.mark_legacy_cleaned()
+    finally:
+        if uploader is not None:
+            uploader.close()
+
+    if args.dry_run:
+        print("✅ Dry run: nothing was embedded or uploaded.")
+        exit()
+    if uploader.failed_batches:
+        print(f"❌ {uploader.failed_batches} batches failed; rerun to retry them.")
+        exit(1)
+    print(f"✅ Ingestion Complete! {uploader.upserted} chunks upserted, {uploader.deleted} deleted.")
@@ -0,0 +1,123 @@
+"""
+Semantic cache of /ask answers.
+
+An entry is stored under (course_id, fingerprint of the packed contexts) and
+holds the question's embedding. A later question with the same course and
+context set is a hit if its embedding is within `threshold` cosine of a cached
+question: "what is recursion?" and "What's recursion" share an answer, but
+only when retrieval handed the LLM the same material.
+
+Entries expire after ttl_s and the least recently used are evicted past
+max_entries.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+
+BucketKey = Tuple[Optional[int], str]
+
+
+def context_fingerprint(contexts: Iterable[Any]) -> str:
+    """Order-independent hash of the contexts' identity (source, note/page, text)."""
+    ids = []
+    for ctx in contexts:
+        page = (ctx.metadata or {}).get("page_number")
+        text_hash = hashlib.sha256(ctx.text.encode("utf-8")).hexdigest()
+        ids.append(f"{ctx.source}|{ctx.note_id}|{ctx.course_id}|{page}|{text_hash}")
+    return hashlib.sha256("\n".join(sorted(ids)).encode("utf-8")).hexdigest()
+
+
+class _Entry(NamedTuple):
+    bucket: BucketKey
+    vector: np.ndarray
+    answer: str
+    created: float
+
+
+class SemanticAnswerCache:
+    def __init__(self, max_entries: int, ttl_s: float, threshold: float):
+        self.max_entries = max(0, int(max_entries))
+        self.ttl_s = float(ttl_s)
+        self.threshold = float(threshold)
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._buckets: Dict[BucketKey, List[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def _unit(vec: Any) -> np.ndarray:
+        v = np.asarray(vec, dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(v))
+        return v / norm if norm else v
+
+    def _drop(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        ids = self._buckets[entry.bucket]
+        ids.remove(entry_id)
+        if not ids:
+            del self._buckets[entry.bucket]
+
+    def get(self, course_id: Optional[int], fingerprint: str, question_vec: Any) -> Optional[str]:
+        if not self.enabled:
+            return None
+        q = self._unit(question_vec)
+        now = time.time()
+        with self._lock:
+            ids = list(self._buckets.get((course_id, fingerprint), ()))
+            live = []
+            for entry_id in ids:
+                if now - self._entries[entry_id].created > self.ttl_s:
+                    self._drop(entry_id)
+                    self.expired += 1
+                else:
+                    live.append(entry_id)
+            if live:
+                sims = np.stack([self._entries[i].vector for i in live]) @ q
+                best = int(np.argmax(sims))
+                if sims[best] >= self.threshold:
+                    entry_id = live[best]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return self._entries[entry_id].answer
+            self.misses += 1
+            return None
+
+    def put(self, course_id: Optional[int], fingerprint: str, question_vec: Any, answer: str) -> None:
+        if not self.enabled:
+            return
+        bucket = (course_id, fingerprint)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = _Entry(bucket, self._unit(question_vec), answer, time.time())
+            self._buckets.setdefault(bucket, []).append(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl_s,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
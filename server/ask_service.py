@@ -1,24 +1,96 @@
 import os
-import math
+import json
+import time
+import asyncio
 import inspect
-from typing import Any, Dict, List, Optional, Callable, Union, Awaitable
+import logging
+import threading
+from contextlib import asynccontextmanager, aclosing
+from typing import Any, AsyncIterator, Dict, List, Optional, Callable, Tuple, Union, Awaitable
 
 import httpx
-from fastapi import HTTPException, FastAPI
+import numpy as np
+from fastapi import HTTPException, FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from langchain_ollama import OllamaLLM
 
+from answer_cache import SemanticAnswerCache, context_fingerprint
+from bm25 import BM25Index
+from bounded_executor import BoundedExecutor
+from context_packing import TokenCounter, pack_contexts
+from observability import REQUEST_ID_HEADER, current_request_id, histogram, install as install_observability
+from trace_sink import TraceSink
+from vector_index import VectorIndex
+
 try:
     from dotenv import load_dotenv  # type: ignore
     load_dotenv()
 except Exception:
     pass
 
+# Per-request debug detail (e.g. /explain-diagram) goes to DEBUG; timings are on /metrics
+logger = logging.getLogger("studysync.ask")
+
 # Env config
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
 SUPABASE_MATCH_FN = os.getenv("SUPABASE_MATCH_FN", "match_course_book_chunks")
 SUPABASE_MATCH_COUNT = int(os.getenv("SUPABASE_MATCH_COUNT", "5"))
+# Contexts that make it into the prompt
+MAX_CONTEXTS = 5
+
+# Course-book search: "supabase" (match RPC), "index" (embedded vector index at
+# BOOK_INDEX_PATH, see vector_index.py), or "auto" = index when a path is set.
+BOOK_SEARCH = os.getenv("BOOK_SEARCH", "auto").strip().lower()
+BOOK_INDEX_PATH = os.getenv("BOOK_INDEX_PATH") or None
+BOOK_INDEX_NPROBE = int(os.getenv("BOOK_INDEX_NPROBE", "8"))
+
+# Hybrid retrieval: BM25 keyword hits (local chunks + book index) are fused with
+# the vector rankings by reciprocal rank fusion before the MAX_CONTEXTS cut.
+# The Supabase RPC has no keyword ranking, so for books this only applies with
+# BOOK_SEARCH=index; Supabase hits are merged with the rest by cosine score.
+HYBRID_SEARCH = os.getenv("ASK_HYBRID", "1") == "1"
+RRF_K = int(os.getenv("ASK_RRF_K", "60"))
+
+# Context packing (context_packing.py): merge overlapping chunks, drop
+# near-duplicates, and fit the rest into a prompt token budget counted with
+# ASK_TOKENIZER (a Hugging Face tokenizer name/path; chars/4 when unset).
+ASK_TOKENIZER = os.getenv("ASK_TOKENIZER") or None
+CONTEXT_TOKEN_BUDGET = int(os.getenv("ASK_CONTEXT_TOKEN_BUDGET", "1500"))
+DEDUPE_THRESHOLD = float(os.getenv("ASK_DEDUPE_THRESHOLD", "0.8"))
+
+# Semantic answer cache (answer_cache.py); ASK_ANSWER_CACHE_SIZE=0 disables it
+ANSWER_CACHE_SIZE = int(os.getenv("ASK_ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL_S = float(os.getenv("ASK_ANSWER_CACHE_TTL_S", "3600"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ASK_ANSWER_CACHE_THRESHOLD", "0.95"))
+
+# Sampled request traces (trace_sink.py): question, stage timings, prompt and
+# answer as JSON lines, plus the last ASK_TRACE_RING_SIZE at GET /ask/debug/traces.
+# ASK_TRACE_SAMPLE_RATE=0 disables tracing; ASK_TRACE_PATH="" keeps memory only.
+TRACE_SAMPLE_RATE = float(os.getenv("ASK_TRACE_SAMPLE_RATE", "0.01"))
+TRACE_PATH = os.getenv("ASK_TRACE_PATH", os.path.join("logs", "ask_traces.jsonl"))
+TRACE_RING_SIZE = int(os.getenv("ASK_TRACE_RING_SIZE", "100"))
+TRACE_MAX_BYTES = int(os.getenv("ASK_TRACE_MAX_BYTES", str(10 * 1024 * 1024)))
+
+# Pooled HTTP clients (one long-lived client per upstream)
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+SUPABASE_POOL_SIZE = int(os.getenv("SUPABASE_POOL_SIZE", "20"))
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "30"))
+SUPABASE_HTTP2 = os.getenv("SUPABASE_HTTP2", "1") == "1"
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "10"))
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "120"))
+EMBEDDING_POOL_SIZE = int(os.getenv("EMBEDDING_POOL_SIZE", "20"))
+EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", "30"))
+
+# LLM admission: concurrent generations should match what Ollama actually runs in parallel
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", os.getenv("OLLAMA_NUM_PARALLEL", "1")))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "8"))
+LLM_RETRY_AFTER = int(os.getenv("LLM_RETRY_AFTER", "10"))
+
+# Retrieval runs Supabase and local scoring concurrently under one deadline;
+# whatever misses it (or fails) is dropped instead of failing the request.
+RETRIEVAL_DEADLINE_S = float(os.getenv("ASK_RETRIEVAL_DEADLINE_S", "8"))
 
 
 class LocalChunk(BaseModel):
@@ -42,6 +114,7 @@ class AskContext(BaseModel):
     note_id: Optional[int] = None
     course_id: Optional[int] = None
     metadata: Optional[Dict[str, Any]] = None
+    rrf_score: Optional[float] = None  # set when contexts were ranked by hybrid fusion
 
 
 class AskResponse(BaseModel):
@@ -64,8 +137,104 @@ class ExplainDiagramResponse(BaseModel):
     explanation: str
 
 
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401  (httpx needs it for HTTP/2)
+        return True
+    except ImportError:
+        return False
+
+
+class _Upstream:
+    """
+    A long-lived, connection-pooled httpx client for one upstream service.
+
+    The client is opened by upstream_clients() (wired into the app lifespan by
+    register_ask_routes) and created lazily if a request arrives first.
+    """
+
+    def __init__(self, name: str, max_connections: int, timeout: float, http2: bool = False):
+        self.name = name
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+        self.timeout = timeout
+        self.http2 = http2 and _http2_available()
+        self._client: Optional[httpx.AsyncClient] = None
+        self.requests = 0
+        self.in_flight = 0
+        self.errors = 0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=self.limits,
+                timeout=httpx.Timeout(self.timeout),
+                http2=self.http2,
+            )
+        return self._client
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        self.requests += 1
+        self.in_flight += 1
+        try:
+            return await self.client.post(url, **kwargs)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "max_connections": self.limits.max_connections,
+            "keepalive_expiry": self.limits.keepalive_expiry,
+            "timeout": self.timeout,
+            "http2": self.http2,
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "errors": self.errors,
+        }
+        # httpcore does not expose pool counters publicly; read them best-effort
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is not None:
+            out["connections"] = len(connections)
+            out["idle_connections"] = sum(1 for c in connections if c.is_idle())
+        return out
+
+
+_upstreams: Dict[str, _Upstream] = {
+    "supabase": _Upstream("supabase", SUPABASE_POOL_SIZE, SUPABASE_TIMEOUT, http2=SUPABASE_HTTP2),
+    "ollama": _Upstream("ollama", OLLAMA_POOL_SIZE, OLLAMA_TIMEOUT),
+    "embedding": _Upstream("embedding", EMBEDDING_POOL_SIZE, EMBEDDING_TIMEOUT),
+}
+
+
+@asynccontextmanager
+async def upstream_clients():
+    """Open the pooled upstream clients for the lifetime of the app."""
+    for upstream in _upstreams.values():
+        upstream.client  # property access creates the pooled client
+    try:
+        yield _upstreams
+    finally:
+        for upstream in _upstreams.values():
+            await upstream.aclose()
+
+
 # Initialize Ollama LLM (lazy loading)
 _llm: Optional[OllamaLLM] = None
+# One shared pool for blocking llm.invoke calls, with a bounded wait queue
+_llm_executor = BoundedExecutor("llm", LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_RETRY_AFTER)
 
 def _get_llm() -> OllamaLLM:
     """Get or create the Ollama LLM instance."""
@@ -84,32 +253,179 @@ async def _call_llm(prompt: str, question: str) -> str:
     """
     try:
         llm = _get_llm()
-        # Run LLM in thread pool since it's synchronous
-        import asyncio
-        from concurrent.futures import ThreadPoolExecutor
-        
-        loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor() as executor:
-            response = await loop.run_in_executor(
-                executor,
-                lambda: llm.invoke(prompt)
-            )
+        # Run LLM on the shared pool since it's synchronous; raises 503 when the queue is full
+        response = await _llm_executor.run(llm.invoke, prompt)
         return str(response.content if hasattr(response, 'content') else response)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"[ERROR] LLM call failed: {e}")
         raise HTTPException(status_code=500, detail=f"LLM call failed: {e}") from e
 
 
-def _cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
-    """Compute cosine similarity between two vectors."""
-    if len(vec1) != len(vec2) or len(vec1) == 0:
-        return 0.0
-    dot = sum(a * b for a, b in zip(vec1, vec2))
-    mag1 = math.sqrt(sum(a * a for a in vec1))
-    mag2 = math.sqrt(sum(b * b for b in vec2))
-    if mag1 == 0 or mag2 == 0:
-        return 0.0
-    return dot / (mag1 * mag2)
+def _sse(event: str, data: Any) -> str:
+    """Format one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _stream_llm(
+    request: Request,
+    prompt: str,
+    contexts: List[AskContext],
+    on_complete: Optional[Callable[[str], None]] = None,
+) -> AsyncIterator[str]:
+    """
+    SSE body for /ask/stream: the retrieved contexts, then token deltas, then a summary.
+
+    The generation holds an LLM slot like _call_llm does. If the client goes
+    away, leaving the loop closes the astream generator, which closes the HTTP
+    stream to Ollama and makes it stop generating. on_complete gets the full
+    message only when generation finished normally.
+    """
+    yield _sse("contexts", [ctx.model_dump() for ctx in contexts])
+
+    started = time.perf_counter()
+    parts: List[str] = []
+    disconnected = False
+    try:
+        async with _llm_executor.slot():
+            async with aclosing(_get_llm().astream(prompt)) as stream:
+                async for delta in stream:
+                    if await request.is_disconnected():
+                        disconnected = True
+                        break
+                    if not delta:
+                        continue
+                    if not parts:
+                        ASK_STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_first_token")
+                    parts.append(delta)
+                    yield _sse("token", {"delta": delta})
+    except HTTPException as e:
+        yield _sse("error", {"status": e.status_code, "detail": e.detail})
+        return
+    except Exception as e:
+        print(f"[ERROR] LLM stream failed: {e}")
+        yield _sse("error", {"status": 500, "detail": f"LLM call failed: {e}"})
+        return
+    if disconnected:
+        return
+    ASK_STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm")
+    if on_complete is not None:
+        on_complete("".join(parts))
+
+    yield _sse(
+        "done",
+        {
+            "message_length": sum(len(p) for p in parts),
+            "deltas": len(parts),
+            "contexts": len(contexts),
+            "elapsed_ms": round((time.perf_counter() - started) * 1000.0, 1),
+        },
+    )
+
+
+async def _stream_cached(contexts: List[AskContext], message: str) -> AsyncIterator[str]:
+    """SSE body for an answer-cache hit: same events as _stream_llm, one token event."""
+    yield _sse("contexts", [ctx.model_dump() for ctx in contexts])
+    yield _sse("token", {"delta": message})
+    yield _sse(
+        "done",
+        {"message_length": len(message), "deltas": 1, "contexts": len(contexts), "elapsed_ms": 0.0, "cached": True},
+    )
+
+
+def _l2_normalize(mat: np.ndarray) -> np.ndarray:
+    """L2-normalize along the last axis; zero vectors stay zero (cosine 0)."""
+    norms = np.linalg.norm(mat, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
+
+
+def _top_k_cosine(query: Any, candidates: Any, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Cosine-rank candidate vectors against the query.
+
+    Candidates are stacked into one contiguous float32 matrix and normalized,
+    so scoring is a single matrix-vector product. argpartition picks the top
+    k without sorting the rest. Returns (indices, scores), best first.
+    """
+    q = np.asarray(query, dtype=np.float32).ravel()
+    mat = np.ascontiguousarray(candidates, dtype=np.float32)
+    if mat.ndim != 2 or mat.shape[0] == 0 or mat.shape[1] != q.shape[0] or k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    scores = _l2_normalize(mat) @ _l2_normalize(q)
+    k = min(k, scores.shape[0])
+    if k < scores.shape[0]:
+        idx = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idx = np.arange(scores.shape[0])
+    idx = idx[np.argsort(-scores[idx], kind="stable")]
+    return idx, scores[idx]
+
+
+_book_index: Optional[VectorIndex] = None
+_book_index_lock = threading.Lock()
+
+
+def _use_book_index() -> bool:
+    if BOOK_SEARCH == "index":
+        return True
+    return BOOK_SEARCH == "auto" and BOOK_INDEX_PATH is not None
+
+
+def _load_book_index() -> VectorIndex:
+    global _book_index
+    with _book_index_lock:
+        if _book_index is None:
+            if not BOOK_INDEX_PATH:
+                raise RuntimeError("BOOK_SEARCH=index needs BOOK_INDEX_PATH")
+            _book_index = VectorIndex(BOOK_INDEX_PATH)
+            print(f"[ask] Loaded book index {BOOK_INDEX_PATH}: {_book_index.info}")
+        return _book_index
+
+
+def _book_index_search(query_vec: Any, match_count: int, course_id: Optional[int]) -> List[AskContext]:
+    index = _load_book_index()
+    hits: List[AskContext] = []
+    for row_id, score in index.search(query_vec, match_count, course_id=course_id, nprobe=BOOK_INDEX_NPROBE):
+        row = index.rows[row_id]
+        hits.append(
+            AskContext(
+                source="book_index",
+                text=row["chunk_text"],
+                score=score,
+                course_id=row.get("course_id"),
+                metadata=row.get("metadata"),
+            )
+        )
+    return hits
+
+
+def _book_keyword_search(
+    question: str,
+    query_vec: Any,
+    match_count: int,
+    course_id: Optional[int],
+) -> List[AskContext]:
+    """BM25 hits from the book index, carrying their cosine score like the vector hits."""
+    index = _load_book_index()
+    found = index.keyword_search(question, match_count, course_id=course_id)
+    if not found:
+        return []
+    cosines = index.cosine([row_id for row_id, _ in found], query_vec)
+    hits: List[AskContext] = []
+    for (row_id, _), score in zip(found, cosines.tolist()):
+        row = index.rows[row_id]
+        hits.append(
+            AskContext(
+                source="book_index",
+                text=row["chunk_text"],
+                score=score,
+                course_id=row.get("course_id"),
+                metadata=row.get("metadata"),
+            )
+        )
+    return hits
 
 
 async def _supabase_match(
@@ -117,6 +433,9 @@ async def _supabase_match(
     match_count: int,
     course_id: Optional[int],
 ) -> List[AskContext]:
+    if _use_book_index():
+        # Off the event loop: the first call loads the index, later ones scan the mmap
+        return await asyncio.to_thread(_book_index_search, query_vec, match_count, course_id)
     if not SUPABASE_URL or not SUPABASE_ANON_KEY:
         return []
     url = f"{SUPABASE_URL}/rest/v1/rpc/{SUPABASE_MATCH_FN}"
@@ -127,14 +446,13 @@ async def _supabase_match(
         "Accept": "application/json",
     }
     payload: Dict[str, Any] = {
-        "query_embedding": query_vec,
+        "query_embedding": np.asarray(query_vec, dtype=float).tolist(),
         "match_count": match_count,
     }
     if course_id is not None:
         payload["filter_course_id"] = course_id
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        resp = await client.post(url, headers=headers, json=payload)
+    resp = await _upstreams["supabase"].post(url, headers=headers, json=payload)
     if resp.status_code != 200:
         raise HTTPException(
             status_code=502,
@@ -162,76 +480,354 @@ async def _supabase_match(
     return hits
 
 
-async def _call_embed(fn: Callable[[str], Union[List[float], Awaitable[List[float]]]], text: str) -> List[float]:
-    res = fn(text)
+# Embeds a list of texts in one call and returns one vector per text, in order.
+EmbedTextsFn = Callable[[List[str]], Union[List[List[float]], Awaitable[List[List[float]]]]]
+
+
+async def _call_embed(fn: EmbedTextsFn, texts: List[str]) -> List[List[float]]:
+    res = fn(texts)
     if inspect.isawaitable(res):
-        return await res
+        res = await res
+    if len(res) != len(texts):
+        raise ValueError(f"expected {len(texts)} vectors, got {len(res)}")
     return res
 
 
-def register_ask_routes(app: FastAPI, embed_text_fn: Callable[[str], Union[List[float], Awaitable[List[float]]]]):
-    @app.post("/ask", response_model=AskResponse)
-    async def ask(req: AskRequest) -> AskResponse:
-        question = (req.question or "").strip()
-        if not question:
-            raise HTTPException(status_code=400, detail="question must be non-empty")
+ASK_STAGE_SECONDS = histogram("ask_stage_seconds", "Time per /ask stage (the Server-Timing stages, plus prompt and llm).", ("stage",))
 
-        try:
-            q_vec = await _call_embed(embed_text_fn, question)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Question embedding failed: {e}") from e
 
-        # Supabase matches
-        supa_hits: List[AskContext] = []
-        try:
-            supa_hits = await _supabase_match(q_vec, req.match_count, req.course_id)
-        except HTTPException:
-            raise
-        except Exception as e:
-            raise HTTPException(status_code=502, detail=f"Supabase call failed: {e}") from e
-
-        # Local chunks from client - score them using embeddings
-        local_hits: List[AskContext] = []
-        for lc in req.local_chunks:
-            txt = (lc.text or "").strip()
-            if not txt:
-                continue
-            # Embed the local chunk text and compute similarity with query
-            try:
-                chunk_vec = await _call_embed(embed_text_fn, txt)
-                similarity = _cosine_similarity(q_vec, chunk_vec)
-            except Exception as e:
-                print(f"[WARNING] Failed to score local chunk: {e}")
-                similarity = 0.0  # Fallback to 0 if embedding fails
-            
-            local_hits.append(
-                AskContext(
-                    source="local",
-                    text=txt,
-                    score=similarity,  # Now properly scored
-                    note_title=lc.note_title,
-                    note_id=lc.note_id,
-                )
+class RetrievalTrace:
+    """Per-request stage timings (ms) and the retrieval stages that were dropped."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+        self.degraded: List[str] = []
+        self.tokens_saved: Optional[int] = None
+        self.query_vec: Any = None  # the question embedding, reused by the answer cache
+        self.answer_cache: Optional[str] = None
+
+    def record(self, stage: str, since: float) -> None:
+        elapsed = time.perf_counter() - since
+        self.timings[stage] = round(elapsed * 1000.0, 2)
+        ASK_STAGE_SECONDS.observe(elapsed, stage=stage)
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{stage};dur={ms}" for stage, ms in self.timings.items())
+
+    def headers(self) -> Dict[str, str]:
+        out = {"Server-Timing": self.server_timing()}
+        if self.degraded:
+            out["X-Retrieval-Degraded"] = ",".join(self.degraded)
+        if self.tokens_saved is not None:
+            out["X-Context-Tokens-Saved"] = str(self.tokens_saved)
+        if self.answer_cache is not None:
+            out["X-Answer-Cache"] = self.answer_cache
+        return out
+
+
+class _RetrievalStats:
+    """Aggregate stage timings and degradations for /ask/health."""
+
+    def __init__(self):
+        self.requests = 0
+        self.degraded: Dict[str, int] = {}
+        self._stage_total: Dict[str, float] = {}
+        self._stage_max: Dict[str, float] = {}
+        self._stage_count: Dict[str, int] = {}
+
+    def add(self, trace: RetrievalTrace) -> None:
+        self.requests += 1
+        for stage in trace.degraded:
+            self.degraded[stage] = self.degraded.get(stage, 0) + 1
+        for stage, ms in trace.timings.items():
+            self._stage_total[stage] = self._stage_total.get(stage, 0.0) + ms
+            self._stage_max[stage] = max(self._stage_max.get(stage, 0.0), ms)
+            self._stage_count[stage] = self._stage_count.get(stage, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "deadline_s": RETRIEVAL_DEADLINE_S,
+            "requests": self.requests,
+            "degraded": dict(self.degraded),
+            "stages": {
+                stage: {
+                    "avg_ms": round(self._stage_total[stage] / n, 2),
+                    "max_ms": self._stage_max[stage],
+                }
+                for stage, n in self._stage_count.items()
+            },
+        }
+
+
+_retrieval_stats = _RetrievalStats()
+
+
+def _rrf_fuse(ranked_lists: List[List[AskContext]], limit: int) -> List[AskContext]:
+    """
+    Reciprocal rank fusion: each context scores sum(1 / (RRF_K + rank)) over
+    the lists it appears in (same source + text = same context), so agreement
+    between keyword and vector rankings beats a high rank in just one.
+    """
+    fused: Dict[Tuple[str, str], float] = {}
+    first: Dict[Tuple[str, str], AskContext] = {}
+    for ranked in ranked_lists:
+        for rank, ctx in enumerate(ranked, start=1):
+            key = (ctx.source, ctx.text)
+            fused[key] = fused.get(key, 0.0) + 1.0 / (RRF_K + rank)
+            first.setdefault(key, ctx)
+    keys = sorted(fused, key=lambda k: (-fused[k], -first[k].score))
+    return [first[k].model_copy(update={"rrf_score": round(fused[k], 6)}) for k in keys[:limit]]
+
+
+async def _retrieve_contexts(
+    req: AskRequest,
+    question: str,
+    embed_texts_fn: EmbedTextsFn,
+    trace: Optional[RetrievalTrace] = None,
+) -> List[AskContext]:
+    """
+    Fetch Supabase matches and rank local chunks concurrently, then return the top contexts.
+
+    The question and the local chunks are embedded in parallel. Supabase starts
+    as soon as the question vector is ready, so its network wait overlaps the
+    local embedding. Both branches share one deadline. A Supabase error or
+    timeout degrades to local-only contexts (and vice versa for local
+    scoring); only a failed question embedding, or losing every branch that
+    was attempted, fails the request. Without local chunks only Supabase is
+    attempted, so its failure is a 504 rather than an answer with no contexts.
+    """
+    trace = trace or RetrievalTrace()
+    deadline = trace.started + RETRIEVAL_DEADLINE_S
+    local_chunks = [lc for lc in req.local_chunks if (lc.text or "").strip()]
+
+    async def embed_question():
+        t0 = time.perf_counter()
+        vecs = await _call_embed(embed_texts_fn, [question])
+        trace.record("embed_question", t0)
+        trace.query_vec = vecs[0]
+        return vecs[0]
+
+    q_task = asyncio.ensure_future(embed_question())
+
+    # Each branch returns ranked candidate lists: vector hits, then BM25 hits when hybrid
+    async def supabase_branch() -> List[List[AskContext]]:
+        q_vec = await q_task
+        t0 = time.perf_counter()
+        hits = await _supabase_match(q_vec, req.match_count, req.course_id)
+        trace.record("supabase", t0)
+        ranked = [hits]
+        if HYBRID_SEARCH and _use_book_index():
+            t0 = time.perf_counter()
+            ranked.append(
+                await asyncio.to_thread(_book_keyword_search, question, q_vec, req.match_count, req.course_id)
+            )
+            trace.record("bm25_book", t0)
+        return ranked
+
+    async def local_branch() -> List[List[AskContext]]:
+        texts = [lc.text.strip() for lc in local_chunks]
+        t0 = time.perf_counter()
+        embed_task = asyncio.ensure_future(_call_embed(embed_texts_fn, texts))
+        keyword_ids: List[int] = []
+        if HYBRID_SEARCH:
+            # Tokenizing a request's chunks is cheap and overlaps the embedding call
+            t1 = time.perf_counter()
+            keyword_ids = [i for i, _ in BM25Index.build(texts).search(question, MAX_CONTEXTS)]
+            trace.record("bm25_local", t1)
+        chunk_vecs = await embed_task
+        trace.record("embed_local", t0)
+        q_vec = await q_task
+        t0 = time.perf_counter()
+        # Only the best MAX_CONTEXTS local chunks per ranking can make the cut
+        top_idx, top_scores = _top_k_cosine(q_vec, chunk_vecs, MAX_CONTEXTS)
+        cosine = dict(zip(top_idx.tolist(), top_scores.tolist()))
+        extra = [i for i in keyword_ids if i not in cosine]
+        if extra:
+            sub_idx, sub_scores = _top_k_cosine(q_vec, [chunk_vecs[i] for i in extra], len(extra))
+            cosine.update((extra[j], s) for j, s in zip(sub_idx.tolist(), sub_scores.tolist()))
+
+        def context(i: int) -> AskContext:
+            lc = local_chunks[i]
+            return AskContext(
+                source="local",
+                text=texts[i],
+                score=cosine.get(i, 0.0),
+                note_title=lc.note_title,
+                note_id=lc.note_id,
             )
-        
-        # Sort local hits by score (descending)
-        local_hits.sort(key=lambda h: h.score, reverse=True)
-
-        # Combine and sort all contexts by score (descending)
-        contexts = supa_hits + local_hits
-        contexts.sort(key=lambda h: h.score, reverse=True)
-        
-        # Keep only top 5 highest scoring contexts
-        contexts = contexts[:5]
-
-        # 1. Format the context chunks first
-        # We separate metadata (Source/Title) from content so the LLM knows what is what.
-        context_text = ""
-        for ctx in contexts:
-            context_text += f"{ctx.text}\n\n"
-        
-        # 2. Construct the V3 "Teacher Persona" Prompt
-        prompt = f"""
+
+        ranked = [[context(i) for i in top_idx.tolist()]]
+        if keyword_ids:
+            ranked.append([context(i) for i in keyword_ids])
+        trace.record("score_local", t0)
+        return ranked
+
+    # Only branches with something to search are attempted: a request without
+    # local chunks must not count an empty local branch as a success
+    branches = {"supabase": asyncio.ensure_future(supabase_branch())}
+    if local_chunks:
+        branches["local"] = asyncio.ensure_future(local_branch())
+    try:
+        done, pending = await asyncio.wait(
+            [q_task, *branches.values()],
+            timeout=max(0.0, deadline - time.perf_counter()),
+        )
+    finally:
+        for task in [q_task, *branches.values()]:
+            if not task.done():
+                task.cancel()
+        # Let cancelled tasks unwind, and retrieve exceptions so none go unobserved
+        await asyncio.gather(q_task, *branches.values(), return_exceptions=True)
+    trace.record("retrieval", trace.started)
+
+    if q_task.done() and not q_task.cancelled() and q_task.exception() is not None:
+        _retrieval_stats.add(trace)
+        e = q_task.exception()
+        raise HTTPException(status_code=500, detail=f"Question embedding failed: {e}") from e
+
+    results: Dict[str, List[List[AskContext]]] = {}
+    for name, task in branches.items():
+        if task not in done:
+            print(f"[WARNING] Retrieval stage '{name}' missed the {RETRIEVAL_DEADLINE_S}s deadline; skipping it")
+            trace.degraded.append(name)
+        elif task.exception() is not None:
+            print(f"[WARNING] Retrieval stage '{name}' failed; skipping it: {task.exception()}")
+            trace.degraded.append(name)
+        else:
+            results[name] = task.result()
+    _retrieval_stats.add(trace)
+    if not results:
+        raise HTTPException(
+            status_code=504, detail=f"Retrieval failed or timed out for every source ({', '.join(branches)})."
+        )
+
+    # Per source: [vector hits] or [vector hits, keyword hits]
+    sources = [ranked for ranked in (results.get("supabase"), results.get("local")) if ranked]
+    if HYBRID_SEARCH and all(len(ranked) > 1 for ranked in sources):
+        return _rrf_fuse([hits for ranked in sources for hits in ranked], MAX_CONTEXTS)
+
+    # A source without keyword hits (Supabase) has no second ranking to fuse, and
+    # its ranks say nothing about another source's; fuse within the sources that
+    # have one, then combine and sort all contexts by score (descending)
+    contexts = []
+    for ranked in sources:
+        contexts.extend(_rrf_fuse(ranked, MAX_CONTEXTS) if len(ranked) > 1 else ranked[0])
+    contexts.sort(key=lambda h: h.score, reverse=True)
+    
+    # Keep only top MAX_CONTEXTS highest scoring contexts
+    contexts = contexts[:MAX_CONTEXTS]
+
+    return contexts
+
+
+_token_counter = TokenCounter(ASK_TOKENIZER)
+
+
+class _PackingStats:
+    def __init__(self):
+        self.requests = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.merged = 0
+        self.duplicates = 0
+        self.over_budget = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tokenizer": ASK_TOKENIZER if _token_counter.exact else "chars/4",
+            "token_budget": CONTEXT_TOKEN_BUDGET,
+            "requests": self.requests,
+            "tokens_before": self.tokens_before,
+            "tokens_after": self.tokens_after,
+            "tokens_saved": self.tokens_before - self.tokens_after,
+            "merged": self.merged,
+            "duplicates": self.duplicates,
+            "over_budget": self.over_budget,
+        }
+
+
+_packing_stats = _PackingStats()
+
+
+async def _pack_contexts(contexts: List[AskContext], trace: RetrievalTrace) -> List[AskContext]:
+    """Dedupe/merge contexts and fit them to the token budget; records tokens saved."""
+    t0 = time.perf_counter()
+    # Off the loop: the first call may load the tokenizer
+    result = await asyncio.to_thread(
+        pack_contexts, contexts, _token_counter, CONTEXT_TOKEN_BUDGET, DEDUPE_THRESHOLD
+    )
+    trace.record("pack", t0)
+    trace.tokens_saved = result.tokens_before - result.tokens_after
+    _packing_stats.requests += 1
+    _packing_stats.tokens_before += result.tokens_before
+    _packing_stats.tokens_after += result.tokens_after
+    _packing_stats.merged += result.merged
+    _packing_stats.duplicates += result.duplicates
+    _packing_stats.over_budget += result.over_budget
+    return result.contexts
+
+
+_answer_cache = SemanticAnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL_S, ANSWER_CACHE_THRESHOLD)
+
+
+def _cached_answer(req: AskRequest, contexts: List[AskContext], trace: RetrievalTrace) -> Tuple[str, Optional[str]]:
+    """(context fingerprint, cached answer or None); marks the trace hit/miss."""
+    fingerprint = context_fingerprint(contexts)
+    if not _answer_cache.enabled or trace.query_vec is None:
+        return fingerprint, None
+    answer = _answer_cache.get(req.course_id, fingerprint, trace.query_vec)
+    trace.answer_cache = "hit" if answer is not None else "miss"
+    return fingerprint, answer
+
+
+_trace_sink = TraceSink(TRACE_PATH, TRACE_SAMPLE_RATE, TRACE_RING_SIZE, TRACE_MAX_BYTES)
+
+
+def _sample_trace(
+    req: AskRequest,
+    question: str,
+    contexts: List[AskContext],
+    trace: RetrievalTrace,
+    message: str,
+    prompt: Optional[str] = None,
+    route: str = "/ask",
+) -> None:
+    """Hand a sampled request's trace to the background writer; a queue put on the loop."""
+    if not _trace_sink.should_sample():
+        return
+    _trace_sink.record(
+        {
+            "ts": time.time(),
+            "request_id": current_request_id(),
+            "route": route,
+            "question": question,
+            "course_id": req.course_id,
+            "local_chunks": len(req.local_chunks),
+            "contexts": [
+                {"source": c.source, "score": c.score, "note_id": c.note_id, "chars": len(c.text)}
+                for c in contexts
+            ],
+            "timings_ms": dict(trace.timings),
+            "degraded": list(trace.degraded),
+            "tokens_saved": trace.tokens_saved,
+            "answer_cache": trace.answer_cache,
+            "prompt": prompt,
+            "response": message,
+        }
+    )
+
+
+def _build_prompt(question: str, contexts: List[AskContext]) -> str:
+    """Construct the tutor prompt from the retrieved contexts."""
+    # 1. Format the context chunks first
+    # We separate metadata (Source/Title) from content so the LLM knows what is what.
+    context_text = ""
+    for ctx in contexts:
+        context_text += f"{ctx.text}\n\n"
+    
+    # 2. Construct the V3 "Teacher Persona" Prompt
+    prompt = f"""
 ### ROLE
 You are a passionate Computer Science Professor. You are explaining a concept to a student during office hours. 
 
@@ -270,46 +866,117 @@ The following text is your internal knowledge. You must teach these concepts as
 **Bad Response:** "Your notes mention the Pixel 9 crashes."
 **Good Response:** "The Pixel 9 has known stability issues regarding frequent crashes."
 """
+    return prompt
+
+
+def register_ask_routes(app: FastAPI, embed_texts_fn: EmbedTextsFn):
+    # Tie the pooled upstream clients to the host app's lifespan
+    inner_lifespan = app.router.lifespan_context
+
+    @asynccontextmanager
+    async def lifespan(a: FastAPI):
+        _trace_sink.start()
+        try:
+            async with upstream_clients():
+                async with inner_lifespan(a) as state:
+                    yield state
+        finally:
+            _trace_sink.stop()
+
+    app.router.lifespan_context = lifespan
+
+    @app.get("/ask/health")
+    async def ask_health() -> Dict[str, Any]:
+        return {
+            "status": "ok",
+            "http_pools": {name: u.stats() for name, u in _upstreams.items()},
+            "llm": _llm_executor.stats(),
+            "retrieval": _retrieval_stats.stats(),
+            "packing": _packing_stats.stats(),
+            "answer_cache": _answer_cache.stats(),
+            "traces": _trace_sink.stats(),
+            "book_search": {
+                "backend": "index" if _use_book_index() else "supabase",
+                "index": _book_index.info if _book_index is not None else None,
+            },
+        }
+
+    @app.post("/ask", response_model=AskResponse)
+    async def ask(req: AskRequest, response: Response) -> AskResponse:
+        question = (req.question or "").strip()
+        if not question:
+            raise HTTPException(status_code=400, detail="question must be non-empty")
+
+        trace = RetrievalTrace()
+        contexts = await _retrieve_contexts(req, question, embed_texts_fn, trace)
+        contexts = await _pack_contexts(contexts, trace)
+        fingerprint, cached = _cached_answer(req, contexts, trace)
+        response.headers.update(trace.headers())
+        if cached is not None:
+            _sample_trace(req, question, contexts, trace, cached)
+            return AskResponse(message=cached)
+        t0 = time.perf_counter()
+        prompt = _build_prompt(question, contexts)
+        trace.record("prompt", t0)
         # Send prompt to LLM
+        t0 = time.perf_counter()
         llm_response = await _call_llm(prompt, question)
-        print(f"[DEBUG] LLM response length: {len(llm_response)}")
-        print(f"[DEBUG] LLM response preview: {llm_response[:100]}...")
-        
-        # Dump prompt and response to temp.txt for debugging/integration
-        try:
-            from datetime import datetime
-            with open("temp.txt", "w", encoding="utf-8") as f:
-                f.write("=" * 80 + "\n")
-                f.write("AI Tutor Response\n")
-                f.write("=" * 80 + "\n")
-                f.write(f"Question: {question}\n")
-                f.write(f"Timestamp: {datetime.now().isoformat()}\n")
-                f.write(f"Number of contexts used: {len(contexts)}\n\n")
-                f.write("=" * 80 + "\n")
-                f.write("PROMPT SENT TO LLM:\n")
-                f.write("=" * 80 + "\n")
-                f.write(prompt)
-                f.write("\n\n")
-                f.write("=" * 80 + "\n")
-                f.write("LLM RESPONSE:\n")
-                f.write("=" * 80 + "\n")
-                f.write(llm_response)
-                f.write("\n")
-                f.write("=" * 80 + "\n")
-            print(f"[DEBUG] Saved prompt and response to temp.txt")
-        except Exception as e:
-            print(f"[WARNING] Failed to write to temp.txt: {e}")
-        
-        response = AskResponse(message=llm_response)
-        print(f"[DEBUG] Returning response with message length: {len(response.message)}")
-        return response
+        trace.record("llm", t0)
+        response.headers.update(trace.headers())  # Server-Timing now covers prompt and llm too
+        _answer_cache.put(req.course_id, fingerprint, trace.query_vec, llm_response)
+        _sample_trace(req, question, contexts, trace, llm_response, prompt)
+        return AskResponse(message=llm_response)
+
+    @app.get("/ask/debug/traces")
+    async def ask_debug_traces(limit: int = 20) -> Dict[str, Any]:
+        """The most recent sampled /ask traces, newest first."""
+        return {"traces": _trace_sink.recent(limit), **_trace_sink.stats()}
+
+    @app.post("/ask/stream")
+    async def ask_stream(req: AskRequest, request: Request) -> StreamingResponse:
+        """
+        Streaming variant of /ask over Server-Sent Events.
+
+        Events: `contexts` (retrieved chunks), `token` ({"delta": ...}) per
+        generated piece, then `done` with a summary, or `error` if the LLM fails.
+        """
+        question = (req.question or "").strip()
+        if not question:
+            raise HTTPException(status_code=400, detail="question must be non-empty")
+
+        trace = RetrievalTrace()
+        contexts = await _retrieve_contexts(req, question, embed_texts_fn, trace)
+        contexts = await _pack_contexts(contexts, trace)
+        fingerprint, cached = _cached_answer(req, contexts, trace)
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **trace.headers()}
+        if cached is not None:
+            _sample_trace(req, question, contexts, trace, cached, route="/ask/stream")
+            return StreamingResponse(
+                _stream_cached(contexts, cached), media_type="text/event-stream", headers=headers
+            )
+        t0 = time.perf_counter()
+        prompt = _build_prompt(question, contexts)
+        trace.record("prompt", t0)
+        # Reject here while a 503 status can still be sent
+        _llm_executor.check_admission()
+        query_vec = trace.query_vec
+
+        def on_complete(message: str) -> None:
+            _answer_cache.put(req.course_id, fingerprint, query_vec, message)
+            _sample_trace(req, question, contexts, trace, message, prompt, route="/ask/stream")
+
+        return StreamingResponse(
+            _stream_llm(request, prompt, contexts, on_complete=on_complete),
+            media_type="text/event-stream",
+            headers=headers,
+        )
 
     @app.post("/explain-diagram", response_model=ExplainDiagramResponse)
     async def explain_diagram(req: ExplainDiagramRequest) -> ExplainDiagramResponse:
         """Send a diagram image to the same Ollama model used by the AI tutor."""
         model_name = os.getenv("OLLAMA_MODEL", "phi")
         base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
-        print(f"[DIAGRAM] Explaining diagram with model={model_name}")
+        logger.debug("explaining diagram with model=%s", model_name)
 
         # Build prompt with optional OCR context
         if req.prompt:
@@ -326,21 +993,20 @@ The following text is your internal knowledge. You must teach these concepts as
                 "Describe what it represents, the relationships between "
                 "components, and any key concepts illustrated."
             )
-        print(f"[DIAGRAM] Prompt length: {len(full_prompt)} chars")
+        logger.debug("diagram prompt length: %d chars", len(full_prompt))
 
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                payload = {
-                    "model": model_name,
-                    "prompt": full_prompt,
-                    "images": [req.image_base64],
-                    "stream": False,
-                }
-                resp = await client.post(f"{base_url}/api/generate", json=payload)
+            payload = {
+                "model": model_name,
+                "prompt": full_prompt,
+                "images": [req.image_base64],
+                "stream": False,
+            }
+            resp = await _upstreams["ollama"].post(f"{base_url}/api/generate", json=payload)
             resp.raise_for_status()
             data = resp.json()
             explanation = data.get("response", "")
-            print(f"[DIAGRAM] Got explanation ({len(explanation)} chars)")
+            logger.debug("diagram explanation: %d chars", len(explanation))
             return ExplainDiagramResponse(explanation=explanation)
         except Exception as e:
             print(f"[ERROR] Diagram explanation failed: {e}")
@@ -353,7 +1019,7 @@ The following text is your internal knowledge. You must teach these concepts as
 if __name__ == "__main__":
     import uvicorn
 
-    async def remote_embed_text(text: str) -> List[float]:
+    async def remote_embed_text(texts: List[str]) -> np.ndarray:
         # Connect to embedding service
         # Default to localhost:8001 if not specified
         emb_url = os.getenv("EMBEDDING_SERVER_URL", "http://localhost:8001")
@@ -361,19 +1027,25 @@ if __name__ == "__main__":
         if emb_url.endswith("/"):
             emb_url = emb_url[:-1]
             
-        async with httpx.AsyncClient() as client:
-            # We assume embedding service endpoint is /embedding/embed
-            # server/embedding_service.py has: @app.post("/embedding/embed")
-            resp = await client.post(
-                f"{emb_url}/embedding/embed",
-                json={"text": text},
-                timeout=30.0
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            return data["vector"]
+        # One round-trip per batch (question, or all local chunks), over the pooled client
+        # server/embedding_service.py has: @app.post("/embedding/embed-batch")
+        # Raw little-endian float32 instead of JSON: no float <-> decimal text round-trip
+        headers = {"Accept": "application/x-float32"}
+        rid = current_request_id()
+        if rid:
+            headers[REQUEST_ID_HEADER] = rid
+        resp = await _upstreams["embedding"].post(
+            f"{emb_url}/embedding/embed-batch",
+            json={"texts": texts},
+            headers=headers,
+        )
+        resp.raise_for_status()
+        count = int(resp.headers["X-Vector-Count"])
+        dim = int(resp.headers["X-Vector-Dim"])
+        return np.frombuffer(resp.content, dtype="<f4").reshape(count, dim)
 
     app = FastAPI(title="Ask Service Standalone")
+    install_observability(app, "ask")
     
     register_ask_routes(app, remote_embed_text)
     
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Parity check + throughput for the embedding service's ONNX backends.
+
+Encodes the same texts with SentenceTransformer (torch) and with OnnxEmbedder
+over model.onnx and, if present, model.int8.onnx. Every text must reach
+cosine >= --min-cosine against torch; the script exits 1 otherwise, so it can
+gate a re-export. Then reports texts/second per backend and batch size.
+
+Export first:  python scripts/export_minilm_onnx.py -o models/embedding-onnx --quantize
+Run from server/:  python bench/bench_onnx_backend.py
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sentence_transformers import SentenceTransformer  # noqa: E402
+
+from onnx_embedder import OnnxEmbedder  # noqa: E402
+
+
+SAMPLE_TEXTS = [
+    "What is the difference between a process and a thread?",
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "int main() { printf(\"hello\\n\"); return 0; }",
+    "The derivative of sin(x) is cos(x).",
+    "a",
+    "Recursion is when a function calls itself until it reaches a base case.",
+]
+WORDS = (
+    "array pointer loop function memory stack heap compiler variable integer "
+    "string recursion algorithm complexity sorting search tree graph node edge"
+).split()
+
+
+def build_texts(n: int, seed: int = 0) -> List[str]:
+    """Fixed samples plus random note-like chunks, some past the 256-token limit."""
+    rng = random.Random(seed)
+    texts = list(SAMPLE_TEXTS)
+    while len(texts) < n:
+        length = rng.choice([8, 40, 120, 400])
+        texts.append(" ".join(rng.choice(WORDS) for _ in range(length)))
+    return texts[:n]
+
+
+def throughput(encode: Callable[[List[str]], np.ndarray], texts: List[str], repeats: int) -> float:
+    encode(texts[:8])  # warm-up
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        encode(texts)
+        best = min(best, time.perf_counter() - t0)
+    return len(texts) / best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=os.getenv("EMB_MODEL_PATH", os.path.join("models", "embedding")))
+    parser.add_argument("--onnx-dir", default=os.getenv("EMB_ONNX_PATH", os.path.join("models", "embedding-onnx")))
+    parser.add_argument("--max-length", type=int, default=int(os.getenv("EMB_ONNX_MAX_LENGTH", "256")))
+    parser.add_argument("--texts", type=int, default=256)
+    parser.add_argument("--batch-sizes", default="1,16,64")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--min-cosine", type=float, default=0.99)
+    args = parser.parse_args()
+
+    texts = build_texts(args.texts)
+    torch_model = SentenceTransformer(args.model, device="cpu")
+    backends: Dict[str, Callable[..., np.ndarray]] = {
+        "torch": lambda t, bs=32: torch_model.encode(t, batch_size=bs, show_progress_bar=False),
+    }
+    for name, quantized in (("onnx", False), ("onnx-int8", True)):
+        try:
+            emb = OnnxEmbedder(args.onnx_dir, quantized=quantized, max_length=args.max_length)
+        except FileNotFoundError as e:
+            print(f"[bench] skipping {name}: {e}")
+            continue
+        backends[name] = lambda t, bs=32, emb=emb: emb.encode(t, batch_size=bs)
+
+    reference = np.asarray(backends["torch"](texts), dtype=np.float32)
+    reference /= np.linalg.norm(reference, axis=1, keepdims=True)
+    failed = False
+    print(f"{'backend':>10} {'min cos':>9} {'mean cos':>9}")
+    for name, encode in backends.items():
+        if name == "torch":
+            continue
+        vecs = np.asarray(encode(texts), dtype=np.float32)
+        cos = (vecs * reference).sum(axis=1) / np.linalg.norm(vecs, axis=1)
+        ok = cos.min() >= args.min_cosine
+        failed |= not ok
+        print(f"{name:>10} {cos.min():>9.5f} {cos.mean():>9.5f} {'ok' if ok else 'FAIL'}")
+        if not ok:
+            worst = int(np.argmin(cos))
+            print(f"           worst text #{worst}: {texts[worst][:60]!r}")
+
+    batch_sizes = [int(s) for s in args.batch_sizes.split(",")]
+    print()
+    print(f"{'backend':>10} " + " ".join(f"{f'bs={bs} t/s':>12}" for bs in batch_sizes))
+    for name, encode in backends.items():
+        rates = [throughput(lambda t, bs=bs: encode(t, bs), texts, args.repeats) for bs in batch_sizes]
+        print(f"{name:>10} " + " ".join(f"{r:>12.1f}" for r in rates))
+
+    if failed:
+        print(f"\n[bench] parity FAILED (cosine < {args.min_cosine})")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
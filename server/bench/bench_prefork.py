@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Benchmark: pre-fork serving (prefork.py) as the worker count grows.
+
+For each --workers level it starts `prefork.py <service> --workers N` and
+drives it at N x --concurrency-per-worker for --requests requests. It then
+records per-process memory: RSS, PSS and USS from /proc via psutil. RSS
+counts shared pages in every process that maps them, so summing it
+overstates the real total. PSS splits each shared page between its
+processes, so summed PSS is the real footprint. USS is what each worker
+alone adds.
+
+With --compare-uvicorn every level also runs under `uvicorn --workers N`.
+That is the layout this replaces: uvicorn spawns fresh interpreters, and
+each one imports torch and loads its own copy of the model.
+
+The tiny models from bench/tiny_models.py have almost no weights, so use a
+real checkpoint (or a MiniLM-sized random one) to see the sharing:
+
+  python bench/bench_prefork.py --service embedding --models bench/models --workers 1,2,4 --compare-uvicorn
+
+Linux only (PSS/USS). Run from server/.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List
+
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loadtest import SERVER_DIR, Service, _wait_healthy, run_scenario  # noqa: E402
+
+SCENARIO = {"embedding": "embed-batch", "ocr": "ocr"}
+APP = {"embedding": "embedding_service:app", "ocr": "main:app"}
+
+
+def _mb(n: int) -> float:
+    return round(n / (1024 * 1024), 1)
+
+
+def _memory(proc: psutil.Process) -> Dict[str, Any]:
+    info = proc.memory_full_info()
+    return {"pid": proc.pid, "rss_mb": _mb(info.rss), "pss_mb": _mb(info.pss), "uss_mb": _mb(info.uss)}
+
+
+def _workers(parent: psutil.Process, single_process: bool = False) -> List[psutil.Process]:
+    if single_process:
+        # uvicorn --workers 1 serves from the main process itself
+        return [parent]
+    # uvicorn's spawn-based supervisor also starts a multiprocessing resource tracker
+    return [p for p in parent.children() if "resource_tracker" not in " ".join(p.cmdline())]
+
+
+async def _wait_workers(
+    parent: psutil.Process, workers: int, single_process: bool, url: str, service: str, timeout_s: float
+) -> None:
+    deadline = time.monotonic() + timeout_s
+    while len(_workers(parent, single_process)) < workers:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"only {len(_workers(parent, single_process))} of {workers} workers started")
+        await asyncio.sleep(0.2)
+    await _wait_healthy(service, url, None, timeout_s)
+    # Connections land on whichever worker accepts first; give the rest time to finish their lifespan
+    await asyncio.sleep(2.0 + 0.5 * workers)
+
+
+async def run_level(args: argparse.Namespace, workers: int, mode: str, log_dir: str) -> Dict[str, Any]:
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    if args.models:
+        key = "EMB_MODEL_PATH" if args.service == "embedding" else "OCR_MODEL_PATH"
+        env[key] = os.path.join(args.models, args.service)
+    env.setdefault("OCR_CACHE_DIR", "")
+    if mode == "prefork":
+        cmd = [sys.executable, "prefork.py", args.service]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", APP[args.service]]
+    cmd += ["--workers", str(workers), "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"]
+    name = f"{args.service}-{workers}w-{mode}"
+    single_process = mode == "uvicorn" and workers == 1
+    svc = Service(name, cmd, env, log_dir)
+    url = f"http://127.0.0.1:{args.port}"
+    try:
+        parent = psutil.Process(svc.proc.pid)
+        await _wait_workers(parent, workers, single_process, url, args.service, args.startup_timeout)
+        idle = [_memory(p) for p in _workers(parent, single_process)]
+        result = await run_scenario(
+            SCENARIO[args.service],
+            {args.service: url},
+            workers * args.concurrency_per_worker,
+            args.requests,
+            args.warmup,
+            args.timeout,
+        )
+        loaded = [_memory(p) for p in _workers(parent, single_process)]
+        parent_mem = None if single_process else _memory(parent)
+    finally:
+        svc.stop()
+    return {
+        "workers": workers,
+        "mode": mode,
+        "concurrency": workers * args.concurrency_per_worker,
+        "throughput_rps": result["throughput_rps"],
+        "latency_ms": result["latency_ms"],
+        "errors": result["errors"],
+        "parent": parent_mem,
+        "workers_idle": idle,
+        "workers_after_load": loaded,
+        "total_rss_mb": round(sum(p["rss_mb"] for p in [parent_mem, *loaded] if p), 1),
+        "total_pss_mb": round(sum(p["pss_mb"] for p in [parent_mem, *loaded] if p), 1),
+        "peak_tree_rss_mb": svc.rss.peak_mb,
+    }
+
+
+async def _main(args: argparse.Namespace) -> Dict[str, Any]:
+    log_dir = args.log_dir
+    os.makedirs(log_dir, exist_ok=True)
+    modes = ["prefork", "uvicorn"] if args.compare_uvicorn else ["prefork"]
+    results: List[Dict[str, Any]] = []
+    for workers in [int(w) for w in args.workers.split(",") if w.strip()]:
+        for mode in modes:
+            print(f"[bench-prefork] {args.service}: {workers} workers, {mode} ...", file=sys.stderr)
+            row = await run_level(args, workers, mode, log_dir)
+            print(
+                f"[bench-prefork]   {row['throughput_rps']} req/s, total PSS {row['total_pss_mb']} MB, "
+                f"total RSS {row['total_rss_mb']} MB",
+                file=sys.stderr,
+            )
+            results.append(row)
+    return {"service": args.service, "models": args.models, "cores": psutil.cpu_count(), "results": results}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--service", choices=sorted(SCENARIO), default="embedding")
+    parser.add_argument("--models", help="Directory with embedding/ and/or ocr/ (default: the services' own paths)")
+    parser.add_argument("--workers", default="1,2,4", help="Comma list of worker counts")
+    parser.add_argument("--compare-uvicorn", action="store_true", help="Also run each level under uvicorn --workers")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--concurrency-per-worker", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--port", type=int, default=11800)
+    parser.add_argument("--log-dir", default=os.path.join(SERVER_DIR, "logs", "bench_prefork"))
+    parser.add_argument("--out", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(_main(args))
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
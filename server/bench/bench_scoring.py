@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: local-chunk ranking in /ask.
+
+Compares the old per-chunk pure-Python cosine + full sort of AskContext
+objects against ask_service._top_k_cosine (one float32 matrix-vector product
++ argpartition) at 10, 100 and 10k chunks of 384-dim vectors.
+
+Both sides start from the list-of-lists vectors the embed function returns,
+so stacking into a matrix is included in the vectorized timing. The last
+column scores an already-stacked float32 matrix for comparison.
+
+Run from server/:  python bench/bench_scoring.py
+"""
+from __future__ import annotations
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+from typing import Callable, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ask_service import AskContext, MAX_CONTEXTS, _top_k_cosine  # noqa: E402
+
+
+def _cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
+    """The pre-vectorization implementation, kept here as the baseline."""
+    if len(vec1) != len(vec2) or len(vec1) == 0:
+        return 0.0
+    dot = sum(a * b for a, b in zip(vec1, vec2))
+    mag1 = math.sqrt(sum(a * a for a in vec1))
+    mag2 = math.sqrt(sum(b * b for b in vec2))
+    if mag1 == 0 or mag2 == 0:
+        return 0.0
+    return dot / (mag1 * mag2)
+
+
+def rank_python(q: List[float], vecs: List[List[float]]) -> List[AskContext]:
+    hits = [AskContext(source="local", text="", score=_cosine_similarity(q, v)) for v in vecs]
+    hits.sort(key=lambda h: h.score, reverse=True)
+    return hits[:MAX_CONTEXTS]
+
+
+def rank_numpy(q: List[float], vecs: List[List[float]]) -> List[AskContext]:
+    idx, scores = _top_k_cosine(q, vecs, MAX_CONTEXTS)
+    return [AskContext(source="local", text="", score=s) for s in scores.tolist()]
+
+
+def best_of(fn: Callable[[], object], repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000.0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,100,10000", help="Comma-separated chunk counts")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    q = [rng.gauss(0, 1) for _ in range(args.dim)]
+    print(f"{'chunks':>8} {'python ms':>11} {'numpy ms':>10} {'speedup':>8} {'stacked ms':>11}")
+    for n in (int(s) for s in args.sizes.split(",")):
+        vecs = [[rng.gauss(0, 1) for _ in range(args.dim)] for _ in range(n)]
+        slow = rank_python(q, vecs)
+        fast = rank_numpy(q, vecs)
+        for a, b in zip(slow, fast):
+            assert abs(a.score - b.score) < 1e-4, (a.score, b.score)
+        t_py = best_of(lambda: rank_python(q, vecs), args.repeats)
+        t_np = best_of(lambda: rank_numpy(q, vecs), args.repeats)
+        mat = np.asarray(vecs, dtype=np.float32)
+        t_mat = best_of(lambda: rank_numpy(q, mat), args.repeats)
+        print(f"{n:>8} {t_py:>11.3f} {t_np:>10.3f} {t_py / t_np:>7.1f}x {t_mat:>11.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
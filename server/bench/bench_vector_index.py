@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Recall and latency of vector_index.VectorIndex against exact search.
+
+By default builds synthetic clustered 384-dim "courses" (unit vectors around
+random topic centres) at a few sizes, indexes each with and without IVF, and
+queries with perturbed copies of stored chunks. For each nprobe it reports
+recall@k against the exact top-k and per-query p50/p95 latency, with and
+without a course_id filter.
+
+--index DIR benchmarks an existing index built from a real export instead
+(queries are perturbed stored vectors).
+
+Run from server/:  python bench/bench_vector_index.py
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vector_index import VectorIndex, build_index  # noqa: E402
+
+
+def synthetic_export(path: str, n: int, dim: int, courses: int, seed: int = 0) -> None:
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((max(8, n // 200), dim)).astype(np.float32)
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(n):
+            vec = topics[rng.integers(len(topics))] + 0.6 * rng.standard_normal(dim).astype(np.float32)
+            f.write(json.dumps({
+                "course_id": int(i % courses) + 1,
+                "chunk_text": f"chunk {i}",
+                "vector_data": vec.round(5).tolist(),
+                "metadata": {"page_number": i // 3},
+            }) + "\n")
+
+
+def make_queries(index: VectorIndex, count: int, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(index), size=min(count, len(index)), replace=False)
+    base = np.asarray(index.vectors[np.sort(picks)], dtype=np.float32)
+    return base + 0.05 * rng.standard_normal(base.shape).astype(np.float32)
+
+
+def run(index: VectorIndex, queries: np.ndarray, k: int, nprobes: List[int], course_id: Optional[int]) -> None:
+    truth = [{i for i, _ in index.search(q, k, course_id=course_id, exact=True)} for q in queries]
+    settings = [("exact", None)] + ([("ivf", p) for p in nprobes] if index.centroids is not None else [])
+    label = f"course={course_id}" if course_id is not None else "all"
+    for name, nprobe in settings:
+        lat, hits = [], 0
+        for q, expected in zip(queries, truth):
+            t0 = time.perf_counter()
+            got = index.search(q, k, course_id=course_id, exact=nprobe is None, nprobe=nprobe or 0)
+            lat.append((time.perf_counter() - t0) * 1000.0)
+            hits += len(expected & {i for i, _ in got})
+        recall = hits / max(1, sum(len(t) for t in truth))
+        p50, p95 = np.percentile(lat, [50, 95])
+        probe = "-" if nprobe is None else str(nprobe)
+        print(f"{len(index):>8} {label:>10} {name:>6} {probe:>7} {recall:>8.3f} {p50:>9.3f} {p95:>9.3f}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", help="Existing index directory (skips the synthetic build)")
+    parser.add_argument("--sizes", default="2000,50000")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--courses", type=int, default=4)
+    parser.add_argument("--ivf-lists", type=int, default=None, help="Default: sqrt(n) for every size")
+    parser.add_argument("--nprobe", default="1,4,8,16")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=5)
+    args = parser.parse_args()
+    nprobes = [int(p) for p in args.nprobe.split(",")]
+
+    print(f"{'rows':>8} {'filter':>10} {'mode':>6} {'nprobe':>7} {'recall':>8} {'p50 ms':>9} {'p95 ms':>9}")
+    if args.index:
+        index = VectorIndex(args.index)
+        queries = make_queries(index, args.queries)
+        run(index, queries, args.k, nprobes, None)
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in (int(s) for s in args.sizes.split(",")):
+            export = os.path.join(tmp, f"rows-{n}.jsonl")
+            synthetic_export(export, n, args.dim, args.courses)
+            out = os.path.join(tmp, f"index-{n}")
+            lists = args.ivf_lists if args.ivf_lists is not None else int(np.sqrt(n))
+            t0 = time.perf_counter()
+            build_index(export, out, lists)
+            print(f"[bench] built {n} rows, {lists} lists in {time.perf_counter() - t0:.1f}s")
+            index = VectorIndex(out)
+            queries = make_queries(index, args.queries)
+            run(index, queries, args.k, nprobes, None)
+            run(index, queries, args.k, nprobes, 1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
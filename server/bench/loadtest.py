@@ -0,0 +1,580 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test for the OCR (main.py), embedding and ask services.
+
+By default it starts everything itself on local ports: bench/stubs.py in place
+of Ollama and Supabase (latency set with the --ollama-*/--supabase-ms flags),
+the embedding service, the ask service pointed at both, and the OCR service.
+Each scenario is then driven by --concurrency workers until --requests
+requests have completed; every request carries fresh text or a fresh image so
+the services' caches don't turn the run into a cache benchmark (spawned
+services also get their answer/OCR caches disabled unless --keep-caches).
+
+Scenarios: embed, embed-batch, chunk-and-embed, ask, ask-many-chunks, ocr.
+ask-many-chunks sends 32 long local chunks per question. /ask embeds the
+question on its own so the Supabase match can start before that large chunk
+batch is encoded; the ask scenarios report the mean Server-Timing stages
+(embed_question, embed_local, supabase, retrieval, ...) to show the overlap.
+
+The report (stdout, or --out FILE) is JSON: per scenario and concurrency
+level, request/error counts, throughput, p50/p95/p99/mean/max latency and the
+peak RSS of each spawned service (process tree, sampled every 100 ms).
+A spawned ask service also writes --trace-sample-rate of its /ask traces to
+ask_traces.jsonl in the log dir; after shutdown every line is read back and
+must be a JSON object ("traces" in the report; exit status 1 otherwise).
+It also checks degraded retrieval: with every Supabase RPC failing, /ask
+without local chunks must be a 504 and /ask with them a 200 ("retrieval").
+
+CPU-only with the tiny random-weight models from bench/tiny_models.py:
+
+  python bench/tiny_models.py --out bench/models
+  python bench/loadtest.py --models bench/models --scenarios embed,ask --concurrency 1,8,32
+
+Against services that are already running (no spawning, no RSS):
+
+  python bench/loadtest.py --no-spawn --embedding-url http://localhost:8001 \\
+      --ask-url http://localhost:8002 --scenarios embed,ask
+
+Run from server/.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+import numpy as np
+
+try:
+    import psutil  # type: ignore
+except Exception:
+    psutil = None  # type: ignore
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ("embed", "embed-batch", "chunk-and-embed", "ask", "ask-many-chunks", "ocr")
+# Which service each scenario needs
+SCENARIO_SERVICE = {
+    "embed": "embedding",
+    "embed-batch": "embedding",
+    "chunk-and-embed": "embedding",
+    "ask": "ask",
+    "ask-many-chunks": "ask",
+    "ocr": "ocr",
+}
+HEALTH_PATHS = {
+    "stubs": "/health",
+    "embedding": "/embedding/health",
+    "ask": "/ask/health",
+    "ocr": "/ocr/health",
+}
+MAX_ERROR_SAMPLES = 3  # response bodies kept per run, to say *why* requests failed
+WORDS = (
+    "recursion stack frame base case pointer heap array loop call return value "
+    "function variable memory allocation linked list node tree graph sort search "
+    "complexity invariant proof induction lemma matrix vector gradient"
+).split()
+
+
+def _sentence(n_words: int) -> str:
+    # A uuid per text defeats the embedding cache; the words give realistic lengths
+    return f"{uuid.uuid4().hex} " + " ".join(random.choice(WORDS) for _ in range(n_words))
+
+
+def _page_image() -> bytes:
+    from PIL import Image, ImageDraw
+
+    img = Image.new("RGB", (640, 480), "white")
+    draw = ImageDraw.Draw(img)
+    for row in range(12):
+        draw.text((20, 20 + row * 36), _sentence(8)[:70], fill="black")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+# ----------------------------
+# Requests
+# ----------------------------
+async def _embed(client: httpx.AsyncClient, urls: Dict[str, str]) -> httpx.Response:
+    return await client.post(f"{urls['embedding']}/embedding/embed", json={"text": _sentence(24)})
+
+
+async def _embed_batch(client: httpx.AsyncClient, urls: Dict[str, str]) -> httpx.Response:
+    texts = [_sentence(random.randint(8, 120)) for _ in range(16)]
+    return await client.post(f"{urls['embedding']}/embedding/embed-batch", json={"texts": texts})
+
+
+async def _chunk_and_embed(client: httpx.AsyncClient, urls: Dict[str, str]) -> httpx.Response:
+    return await client.post(f"{urls['embedding']}/embedding/chunk-and-embed", json={"text": _sentence(600)})
+
+
+async def _ask(
+    client: httpx.AsyncClient, urls: Dict[str, str], chunks: int = 4, words: int = 60
+) -> httpx.Response:
+    body = {
+        "question": f"What is {random.choice(WORDS)}? ({uuid.uuid4().hex[:8]})",
+        "local_chunks": [
+            {"text": _sentence(words), "note_title": "Lecture notes", "note_id": i} for i in range(chunks)
+        ],
+        "course_id": 1,
+    }
+    return await client.post(f"{urls['ask']}/ask", json=body)
+
+
+async def _ask_many_chunks(client: httpx.AsyncClient, urls: Dict[str, str]) -> httpx.Response:
+    return await _ask(client, urls, chunks=32, words=120)
+
+
+async def _ocr(client: httpx.AsyncClient, urls: Dict[str, str]) -> httpx.Response:
+    image = await asyncio.to_thread(_page_image)
+    return await client.post(f"{urls['ocr']}/ocr", files={"file": ("page.png", image, "image/png")})
+
+
+REQUESTS: Dict[str, Callable[[httpx.AsyncClient, Dict[str, str]], Any]] = {
+    "embed": _embed,
+    "embed-batch": _embed_batch,
+    "chunk-and-embed": _chunk_and_embed,
+    "ask": _ask,
+    "ask-many-chunks": _ask_many_chunks,
+    "ocr": _ocr,
+}
+
+
+# ----------------------------
+# Processes
+# ----------------------------
+class RssSampler:
+    """Peak resident set size of a process tree, sampled in a background thread."""
+
+    def __init__(self, pid: int, interval_s: float = 0.1):
+        self.pid = pid
+        self.interval_s = interval_s
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self) -> int:
+        proc = psutil.Process(self.pid)
+        total = proc.memory_info().rss
+        for child in proc.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.peak_bytes = max(self.peak_bytes, self._sample())
+            except psutil.Error:
+                return
+            self._stop.wait(self.interval_s)
+
+    def start(self) -> "RssSampler":
+        if psutil is not None:
+            self._thread.start()
+        return self
+
+    def reset(self) -> None:
+        self.peak_bytes = 0
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    @property
+    def peak_mb(self) -> Optional[float]:
+        if psutil is None:
+            return None
+        return round(self.peak_bytes / (1024 * 1024), 1)
+
+
+class Service:
+    def __init__(self, name: str, cmd: List[str], env: Dict[str, str], log_dir: str):
+        self.name = name
+        self.log_path = os.path.join(log_dir, f"{name}.log")
+        self._log = open(self.log_path, "wb")
+        self.proc = subprocess.Popen(cmd, cwd=SERVER_DIR, env=env, stdout=self._log, stderr=subprocess.STDOUT)
+        self.rss = RssSampler(self.proc.pid).start()
+
+    def stop(self) -> None:
+        self.rss.stop()
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self._log.close()
+
+
+async def _wait_healthy(name: str, url: str, proc: Optional[subprocess.Popen], timeout_s: float) -> None:
+    deadline = time.monotonic() + timeout_s
+    async with httpx.AsyncClient(timeout=2.0) as client:
+        while time.monotonic() < deadline:
+            if proc is not None and proc.poll() is not None:
+                raise RuntimeError(f"{name} exited with code {proc.returncode}")
+            try:
+                r = await client.get(url + HEALTH_PATHS[name])
+                if r.status_code == 200:
+                    body = r.json()
+                    # /ocr/health reports whether the model has finished loading
+                    if body.get("model_loaded", True):
+                        return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"{name} not healthy at {url} after {timeout_s:.0f}s")
+
+
+def _spawn(args: argparse.Namespace, needed: List[str], log_dir: str) -> Dict[str, Service]:
+    base_env = dict(os.environ, HOST="127.0.0.1", PYTHONUNBUFFERED="1")
+    urls = _local_urls(args)
+    services: Dict[str, Service] = {}
+
+    if "ask" in needed:
+        stub_cmd = [sys.executable, os.path.join("bench", "stubs.py"), "--port", str(args.base_port)]
+        for flag in ("ollama_first_token_ms", "ollama_token_ms", "ollama_tokens", "supabase_ms", "jitter"):
+            stub_cmd += [f"--{flag.replace('_', '-')}", str(getattr(args, flag))]
+        services["stubs"] = Service("stubs", stub_cmd, base_env, log_dir)
+
+    if "embedding" in needed or "ask" in needed:
+        env = dict(base_env)
+        if args.models:
+            env["EMB_MODEL_PATH"] = os.path.join(args.models, "embedding")
+        services["embedding"] = Service(
+            "embedding",
+            [sys.executable, "-m", "uvicorn", "embedding_service:app",
+             "--host", "127.0.0.1", "--port", str(args.base_port + 1), "--log-level", "warning"],
+            env,
+            log_dir,
+        )
+
+    if "ask" in needed:
+        env = dict(
+            base_env,
+            ASK_PORT=str(args.base_port + 2),
+            EMBEDDING_SERVER_URL=urls["embedding"],
+            OLLAMA_BASE_URL=urls["stubs"],
+            SUPABASE_URL=urls["stubs"],
+            SUPABASE_ANON_KEY="bench",
+            SUPABASE_HTTP2="0",
+            BOOK_SEARCH="supabase",
+            ASK_TRACE_SAMPLE_RATE=str(args.trace_sample_rate),
+            ASK_TRACE_PATH=os.path.join(log_dir, "ask_traces.jsonl"),
+        )
+        if not args.keep_caches:
+            env["ASK_ANSWER_CACHE_SIZE"] = "0"
+        services["ask"] = Service("ask", [sys.executable, "ask_service.py"], env, log_dir)
+
+    if "ocr" in needed:
+        env = dict(base_env)
+        if args.models:
+            env["OCR_MODEL_PATH"] = os.path.join(args.models, "ocr")
+        if not args.keep_caches:
+            env["OCR_CACHE_DIR"] = ""
+        services["ocr"] = Service(
+            "ocr",
+            [sys.executable, "-m", "uvicorn", "main:app",
+             "--host", "127.0.0.1", "--port", str(args.base_port + 3), "--log-level", "warning"],
+            env,
+            log_dir,
+        )
+    return services
+
+
+def _local_urls(args: argparse.Namespace) -> Dict[str, str]:
+    return {
+        "stubs": f"http://127.0.0.1:{args.base_port}",
+        "embedding": f"http://127.0.0.1:{args.base_port + 1}",
+        "ask": f"http://127.0.0.1:{args.base_port + 2}",
+        "ocr": f"http://127.0.0.1:{args.base_port + 3}",
+    }
+
+
+def _check_traces(path: str) -> Dict[str, Any]:
+    """Every line the trace sink wrote must parse as one JSON object."""
+    lines = invalid = 0
+    sample = None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    ok = isinstance(json.loads(line), dict)
+                except ValueError:
+                    ok = False
+                if not ok:
+                    invalid += 1
+                    sample = sample or line[:200]
+    return {"path": path, "lines": lines, "invalid": invalid, "invalid_sample": sample}
+
+
+async def _check_retrieval_degraded(urls: Dict[str, str]) -> Dict[str, Any]:
+    """Make the stub's Supabase fail, then ask with and without local chunks."""
+    body = {"question": f"What is recursion? ({uuid.uuid4().hex[:8]})", "course_id": 1}
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        await client.post(f"{urls['stubs']}/config", json={"supabase_error_rate": 1.0})
+        try:
+            no_local = await client.post(f"{urls['ask']}/ask", json={**body, "local_chunks": []})
+            local = await client.post(
+                f"{urls['ask']}/ask",
+                json={**body, "local_chunks": [{"text": _sentence(60), "note_title": "Notes", "note_id": 1}]},
+            )
+        finally:
+            await client.post(f"{urls['stubs']}/config", json={"supabase_error_rate": 0.0})
+    ok = no_local.status_code == 504 and local.status_code == 200
+    return {"ok": ok, "no_local_chunks": no_local.status_code, "local_chunks": local.status_code}
+
+
+# ----------------------------
+# Load
+# ----------------------------
+def _server_timing(header: str) -> Dict[str, float]:
+    # "embed_question;dur=12.3, supabase;dur=40.1" -> {"embed_question": 12.3, ...}
+    stages: Dict[str, float] = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        if params.startswith("dur="):
+            try:
+                stages[name] = float(params[4:])
+            except ValueError:
+                pass
+    return stages
+
+
+def _summarize(
+    latencies_s: List[float],
+    statuses: Counter,
+    errors: List[str],
+    elapsed_s: float,
+    stages: Optional[Dict[str, List[float]]] = None,
+) -> Dict[str, Any]:
+    ok = statuses.get(200, 0)
+    lat_ms = np.asarray(latencies_s, dtype=np.float64) * 1000.0
+    latency = None
+    if len(lat_ms):
+        p50, p95, p99 = np.percentile(lat_ms, [50, 95, 99])
+        latency = {
+            "p50": round(float(p50), 2),
+            "p95": round(float(p95), 2),
+            "p99": round(float(p99), 2),
+            "mean": round(float(lat_ms.mean()), 2),
+            "max": round(float(lat_ms.max()), 2),
+        }
+    return {
+        "requests": int(sum(statuses.values())),
+        "errors": int(sum(statuses.values()) - ok),
+        "status_counts": {str(k): v for k, v in sorted(statuses.items(), key=lambda kv: str(kv[0]))},
+        "error_samples": errors,
+        "elapsed_s": round(elapsed_s, 3),
+        "throughput_rps": round(ok / elapsed_s, 2) if elapsed_s > 0 else 0.0,
+        # Latency of successful requests only; errors are counted above
+        "latency_ms": latency,
+        # Mean server-side stage times (Server-Timing), when the service sends them
+        "stages_ms": {k: round(float(np.mean(v)), 2) for k, v in sorted(stages.items())} if stages else None,
+    }
+
+
+async def run_scenario(
+    scenario: str,
+    urls: Dict[str, str],
+    concurrency: int,
+    total: int,
+    warmup: int,
+    timeout_s: float,
+) -> Dict[str, Any]:
+    send = REQUESTS[scenario]
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=timeout_s, limits=limits) as client:
+        for _ in range(warmup):
+            try:
+                await send(client, urls)
+            except httpx.HTTPError:
+                pass
+
+        latencies: List[float] = []
+        statuses: Counter = Counter()
+        errors: List[str] = []
+        stages: Dict[str, List[float]] = {}
+        remaining = total
+
+        async def worker() -> None:
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                try:
+                    r = await send(client, urls)
+                    status: Any = r.status_code
+                    detail = r.text
+                    if status == 200:
+                        for name, ms in _server_timing(r.headers.get("server-timing", "")).items():
+                            stages.setdefault(name, []).append(ms)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                    detail = str(e)
+                if status == 200:
+                    latencies.append(time.perf_counter() - start)
+                elif len(errors) < MAX_ERROR_SAMPLES:
+                    errors.append(f"{status}: {detail[:200]}")
+                statuses[status] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return _summarize(latencies, statuses, errors, elapsed, stages)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SERVER_DIR, capture_output=True, text=True, timeout=10
+        )
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+async def _main(args: argparse.Namespace) -> Dict[str, Any]:
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Unknown scenario(s): {', '.join(unknown)}; choose from {', '.join(SCENARIOS)}")
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    needed = sorted({SCENARIO_SERVICE[s] for s in scenarios})
+
+    services: Dict[str, Service] = {}
+    log_dir = None
+    if args.no_spawn:
+        urls = {"embedding": args.embedding_url, "ask": args.ask_url, "ocr": args.ocr_url}
+        for name in needed:
+            if not urls.get(name):
+                raise SystemExit(f"--no-spawn needs --{name}-url for the selected scenarios")
+            await _wait_healthy(name, urls[name], None, args.startup_timeout)
+    else:
+        urls = _local_urls(args)
+        log_dir = args.log_dir or tempfile.mkdtemp(prefix="studysync-loadtest-")
+        os.makedirs(log_dir, exist_ok=True)
+        print(f"[loadtest] Service logs in {log_dir}", file=sys.stderr)
+        services = _spawn(args, needed, log_dir)
+        try:
+            for name, svc in services.items():
+                await _wait_healthy(name, urls[name], svc.proc, args.startup_timeout)
+        except Exception:
+            for svc in services.values():
+                svc.stop()
+            raise
+
+    report: Dict[str, Any] = {
+        "commit": _git_commit(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {
+            "scenarios": scenarios,
+            "concurrency": levels,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "spawned": not args.no_spawn,
+            "models": args.models,
+            "stubs": {
+                "ollama_first_token_ms": args.ollama_first_token_ms,
+                "ollama_token_ms": args.ollama_token_ms,
+                "ollama_tokens": args.ollama_tokens,
+                "supabase_ms": args.supabase_ms,
+                "jitter": args.jitter,
+            } if not args.no_spawn and "ask" in needed else None,
+        },
+        "results": [],
+    }
+    try:
+        for scenario in scenarios:
+            for concurrency in levels:
+                for svc in services.values():
+                    svc.rss.reset()
+                print(f"[loadtest] {scenario} @ concurrency {concurrency} ...", file=sys.stderr)
+                result = await run_scenario(
+                    scenario, urls, concurrency, args.requests, args.warmup, args.timeout
+                )
+                result = {"scenario": scenario, "concurrency": concurrency, **result}
+                if services:
+                    result["peak_rss_mb"] = {name: svc.rss.peak_mb for name, svc in services.items()}
+                report["results"].append(result)
+                lat = result["latency_ms"] or {}
+                print(
+                    f"[loadtest]   {result['throughput_rps']} req/s, p50 {lat.get('p50')} ms, "
+                    f"p99 {lat.get('p99')} ms, errors {result['errors']}",
+                    file=sys.stderr,
+                )
+        if "ask" in services:
+            report["retrieval"] = await _check_retrieval_degraded(urls)
+            print(f"[loadtest] degraded retrieval: {report['retrieval']}", file=sys.stderr)
+    finally:
+        for svc in services.values():
+            svc.stop()
+    if "ask" in services:
+        # Checked after stop(): the sink flushes its queue on shutdown
+        report["traces"] = _check_traces(os.path.join(log_dir, "ask_traces.jsonl"))
+        print(
+            f"[loadtest] ask traces: {report['traces']['lines']} lines, "
+            f"{report['traces']['invalid']} not JSON objects",
+            file=sys.stderr,
+        )
+    return report
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="embed,embed-batch,ask", help=f"Comma list of {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma list of concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario and level")
+    parser.add_argument("--warmup", type=int, default=5, help="Unmeasured requests before each run")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-request timeout (s)")
+    parser.add_argument("--out", help="Write the JSON report here instead of stdout")
+
+    spawn = parser.add_argument_group("spawned services")
+    spawn.add_argument("--models", help="Directory from bench/tiny_models.py (default: the services' own paths)")
+    spawn.add_argument("--base-port", type=int, default=11500, help="stubs, embedding, ask, ocr on +0..+3")
+    spawn.add_argument("--keep-caches", action="store_true", help="Leave answer/OCR caches at their defaults")
+    spawn.add_argument("--startup-timeout", type=float, default=180.0)
+    spawn.add_argument("--log-dir", help="Service logs (default: a temp dir)")
+    spawn.add_argument("--ollama-first-token-ms", type=float, default=200.0)
+    spawn.add_argument("--ollama-token-ms", type=float, default=20.0)
+    spawn.add_argument("--ollama-tokens", type=float, default=50.0)
+    spawn.add_argument("--supabase-ms", type=float, default=40.0)
+    spawn.add_argument("--jitter", type=float, default=0.1)
+    spawn.add_argument("--trace-sample-rate", type=float, default=0.1, help="ASK_TRACE_SAMPLE_RATE for the ask service")
+
+    remote = parser.add_argument_group("existing services")
+    remote.add_argument("--no-spawn", action="store_true", help="Load services that are already running")
+    remote.add_argument("--embedding-url", default="http://localhost:8001")
+    remote.add_argument("--ask-url", default="http://localhost:8002")
+    remote.add_argument("--ocr-url", default="http://localhost:8000")
+    args = parser.parse_args()
+
+    report = asyncio.run(_main(args))
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"[loadtest] Wrote {args.out}", file=sys.stderr)
+    else:
+        print(text)
+    failed = report.get("traces", {}).get("invalid") or not report.get("retrieval", {}).get("ok", True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
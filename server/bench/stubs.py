@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for Ollama and the Supabase match RPC, with injectable latency.
+
+  POST /api/generate          Ollama: JSON or NDJSON stream (stream=true)
+  POST /rest/v1/rpc/{fn}      Supabase RPC: `match_count` rows shaped like
+                              match_course_book_chunks output
+
+Latency knobs (CLI flags or the matching env vars, all in milliseconds):
+  --ollama-first-token-ms  STUB_OLLAMA_FIRST_TOKEN_MS  before the first token
+  --ollama-token-ms        STUB_OLLAMA_TOKEN_MS        between tokens
+  --ollama-tokens          STUB_OLLAMA_TOKENS          tokens per answer
+  --supabase-ms            STUB_SUPABASE_MS            per RPC call
+  --supabase-error-rate    STUB_SUPABASE_ERROR_RATE    fraction of RPCs answered with a 500
+  --jitter                 STUB_JITTER                 +/- fraction applied to each delay
+
+Run from server/:  python bench/stubs.py --port 11500
+Then point the ask service at it with OLLAMA_BASE_URL / SUPABASE_URL.
+POST /config with a JSON object of knobs changes them on a running stub.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+from typing import Any, Dict
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+CONFIG: Dict[str, float] = {
+    "ollama_first_token_ms": float(os.getenv("STUB_OLLAMA_FIRST_TOKEN_MS", "200")),
+    "ollama_token_ms": float(os.getenv("STUB_OLLAMA_TOKEN_MS", "20")),
+    "ollama_tokens": float(os.getenv("STUB_OLLAMA_TOKENS", "50")),
+    "supabase_ms": float(os.getenv("STUB_SUPABASE_MS", "40")),
+    "supabase_error_rate": float(os.getenv("STUB_SUPABASE_ERROR_RATE", "0")),
+    "jitter": float(os.getenv("STUB_JITTER", "0.1")),
+}
+WORDS = "recursion stack frame base case pointer heap array loop call return value".split()
+
+app = FastAPI(title="Bench stubs")
+
+
+async def _delay(ms: float) -> None:
+    if ms <= 0:
+        return
+    jitter = CONFIG["jitter"]
+    await asyncio.sleep(ms * random.uniform(1 - jitter, 1 + jitter) / 1000.0)
+
+
+@app.post("/api/generate")
+async def generate(req: Request):
+    body: Dict[str, Any] = await req.json()
+    model = body.get("model", "stub")
+    tokens = [random.choice(WORDS) + " " for _ in range(int(CONFIG["ollama_tokens"]))]
+
+    if not body.get("stream", True):
+        await _delay(CONFIG["ollama_first_token_ms"] + CONFIG["ollama_token_ms"] * len(tokens))
+        return JSONResponse({"model": model, "response": "".join(tokens), "done": True})
+
+    async def stream():
+        await _delay(CONFIG["ollama_first_token_ms"])
+        for i, tok in enumerate(tokens):
+            if i:
+                await _delay(CONFIG["ollama_token_ms"])
+            yield json.dumps({"model": model, "response": tok, "done": False}) + "\n"
+        yield json.dumps({"model": model, "response": "", "done": True, "done_reason": "stop"}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.post("/rest/v1/rpc/{fn}")
+async def supabase_rpc(fn: str, req: Request):
+    body: Dict[str, Any] = await req.json()
+    await _delay(CONFIG["supabase_ms"])
+    if random.random() < CONFIG["supabase_error_rate"]:
+        return JSONResponse({"message": "stub: injected failure"}, status_code=500)
+    count = int(body.get("match_count") or 5)
+    course_id = body.get("filter_course_id", 1)
+    rows = [
+        {
+            "id": i,
+            "course_id": course_id,
+            "chunk_text": " ".join(random.choice(WORDS) for _ in range(80)),
+            "similarity": round(0.9 - 0.05 * i, 3),
+            "metadata": {"source": "stub.pdf", "page_number": i + 1},
+        }
+        for i in range(count)
+    ]
+    return JSONResponse(rows)
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "config": CONFIG}
+
+
+@app.post("/config")
+async def set_config(req: Request):
+    body: Dict[str, Any] = await req.json()
+    for key, value in body.items():
+        if key in CONFIG:
+            CONFIG[key] = float(value)
+    return {"config": CONFIG}
+
+
+def main() -> int:
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    for key, value in CONFIG.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=float, default=value)
+    args = parser.parse_args()
+    for key in CONFIG:
+        CONFIG[key] = getattr(args, key)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
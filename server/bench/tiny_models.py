@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Tiny random-weight stand-ins for the OCR and embedding models, so the load
+test runs on a CPU-only box without the real checkpoints.
+
+  out/embedding  SentenceTransformer: 2-layer, 32-dim BERT, mean pooling,
+                 normalized (same module layout as all-MiniLM-L6-v2)
+  out/ocr        Kosmos-2.5 with 2-layer, 64-dim text and vision towers,
+                 saved next to the real processor
+
+The numbers they produce are meaningless; only the request path, batching
+and serialization costs are real. The OCR processor (tokenizer + image
+preprocessing) is copied from --ocr-processor, which needs the Hugging Face
+hub or a local checkout of microsoft/kosmos-2.5; use --skip-ocr without one.
+
+Run from server/:  python bench/tiny_models.py --out bench/models
+Then:              EMB_MODEL_PATH=bench/models/embedding OCR_MODEL_PATH=bench/models/ocr
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import string
+import sys
+
+
+def build_embedding(out_dir: str) -> None:
+    from sentence_transformers import SentenceTransformer, models
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+
+    hf_dir = os.path.join(out_dir, "hf")
+    os.makedirs(hf_dir, exist_ok=True)
+    # Single characters (plus ## continuations) so any ASCII text tokenizes to
+    # roughly one token per character: realistic sequence lengths for bucketing.
+    chars = list(string.ascii_lowercase + string.digits + string.punctuation)
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + chars + ["##" + c for c in chars]
+    vocab_path = os.path.join(hf_dir, "vocab.txt")
+    with open(vocab_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(vocab))
+    tokenizer = BertTokenizerFast(vocab_file=vocab_path)
+    config = BertConfig(
+        vocab_size=len(vocab),
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        max_position_embeddings=512,
+    )
+    BertModel(config).save_pretrained(hf_dir)
+    tokenizer.save_pretrained(hf_dir)
+
+    transformer = models.Transformer(hf_dir, max_seq_length=256)
+    pooling = models.Pooling(transformer.get_word_embedding_dimension(), "mean")
+    SentenceTransformer(modules=[transformer, pooling, models.Normalize()]).save(out_dir)
+    print(f"[tiny-models] Wrote embedding model to {out_dir}")
+
+
+def build_ocr(out_dir: str, processor_source: str) -> None:
+    from transformers import AutoProcessor, Kosmos2_5Config, Kosmos2_5ForConditionalGeneration
+
+    processor = AutoProcessor.from_pretrained(processor_source)
+    config = Kosmos2_5Config(
+        text_config={
+            "vocab_size": len(processor.tokenizer),
+            "embed_dim": 64,
+            "layers": 2,
+            "ffn_dim": 128,
+            "attention_heads": 2,
+            "max_position_embeddings": 4096,
+        },
+        vision_config={
+            "hidden_size": 64,
+            "intermediate_size": 128,
+            "num_hidden_layers": 2,
+            "num_attention_heads": 2,
+            "head_dim": 32,
+        },
+        # The processor inserts this many image tokens into every prompt
+        latent_query_num=processor.num_image_tokens,
+    )
+    os.makedirs(out_dir, exist_ok=True)
+    Kosmos2_5ForConditionalGeneration(config).save_pretrained(out_dir)
+    processor.save_pretrained(out_dir)
+    print(f"[tiny-models] Wrote OCR model to {out_dir}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default=os.path.join("bench", "models"))
+    parser.add_argument("--ocr-processor", default="microsoft/kosmos-2.5", help="Hub id or local dir")
+    parser.add_argument("--skip-ocr", action="store_true")
+    parser.add_argument("--skip-embedding", action="store_true")
+    args = parser.parse_args()
+
+    if not args.skip_embedding:
+        build_embedding(os.path.join(args.out, "embedding"))
+    if not args.skip_ocr:
+        build_ocr(os.path.join(args.out, "ocr"), args.ocr_processor)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""
+Okapi BM25 over an inverted index, for keyword hits that embeddings miss
+(function names, error messages, exact terms from code-heavy books).
+
+Per-posting impacts, idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl)),
+are computed once when the index is built, so a query is just a sum of the
+impact arrays of its terms. Book indexes are built at ingestion time next to
+the vector index (see vector_index.py); local note chunks arrive per request
+and are indexed on the fly.
+"""
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+_TOKEN_RE = re.compile(r"[A-Za-z0-9_]+")
+# Pieces of camelCase / snake_case identifiers: NullPointerException -> null, pointer, exception
+_PART_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it its of on or "
+    "that the this to was what when where which who why with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens; identifiers also contribute their camel/snake parts."""
+    out: List[str] = []
+    for tok in _TOKEN_RE.findall(text):
+        low = tok.lower()
+        if low not in _STOPWORDS:
+            out.append(low)
+        parts = _PART_RE.findall(tok)
+        if len(parts) > 1:
+            out.extend(p.lower() for p in parts if p.lower() not in _STOPWORDS)
+    return out
+
+
+class BM25Index:
+    def __init__(self, vocab: List[str], offsets: np.ndarray, doc_ids: np.ndarray, impacts: np.ndarray, n_docs: int):
+        self.vocab = vocab
+        self.term_ids: Dict[str, int] = {t: i for i, t in enumerate(vocab)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.impacts = impacts
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, texts: Sequence[str], k1: float = 1.2, b: float = 0.75) -> "BM25Index":
+        term_ids: Dict[str, int] = {}
+        postings: List[List[Tuple[int, int]]] = []
+        doc_lens = np.zeros(len(texts), dtype=np.float32)
+        for doc, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lens[doc] = sum(counts.values())
+            for term, tf in counts.items():
+                tid = term_ids.setdefault(term, len(term_ids))
+                if tid == len(postings):
+                    postings.append([])
+                postings[tid].append((doc, tf))
+        n = len(texts)
+        avgdl = float(doc_lens.mean()) if n and doc_lens.sum() else 1.0
+        offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        doc_ids: List[int] = []
+        impacts: List[float] = []
+        for tid, plist in enumerate(postings):
+            df = len(plist)
+            idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            for doc, tf in plist:
+                norm = k1 * (1.0 - b + b * doc_lens[doc] / avgdl)
+                impacts.append(idf * tf * (k1 + 1.0) / (tf + norm))
+                doc_ids.append(doc)
+            offsets[tid + 1] = len(doc_ids)
+        vocab = [""] * len(term_ids)
+        for term, tid in term_ids.items():
+            vocab[tid] = term
+        return cls(
+            vocab,
+            offsets,
+            np.asarray(doc_ids, dtype=np.int32),
+            np.asarray(impacts, dtype=np.float32),
+            n,
+        )
+
+    def search(self, query: str, k: int, rows: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """Top-k (doc id, score) with score > 0, best first; rows restricts the candidates."""
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term in set(tokenize(query)):
+            tid = self.term_ids.get(term)
+            if tid is None:
+                continue
+            lo, hi = self.offsets[tid], self.offsets[tid + 1]
+            # A term lists each doc once, so plain fancy-index += is safe
+            scores[self.doc_ids[lo:hi]] += self.impacts[lo:hi]
+        ids = np.flatnonzero(scores) if rows is None else rows[scores[rows] > 0]
+        if len(ids) == 0 or k <= 0:
+            return []
+        sub = scores[ids]
+        k = min(k, len(ids))
+        top = np.argpartition(-sub, k - 1)[:k] if k < len(ids) else np.arange(len(ids))
+        top = top[np.argsort(-sub[top], kind="stable")]
+        return [(int(ids[i]), float(sub[i])) for i in top]
+
+    def save(self, directory: str) -> None:
+        np.savez(
+            os.path.join(directory, "bm25.npz"),
+            offsets=self.offsets,
+            doc_ids=self.doc_ids,
+            impacts=self.impacts,
+            n_docs=np.int64(self.n_docs),
+        )
+        with open(os.path.join(directory, "bm25_vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(self.vocab, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["BM25Index"]:
+        path = os.path.join(directory, "bm25.npz")
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+        with open(os.path.join(directory, "bm25_vocab.json"), "r", encoding="utf-8") as f:
+            vocab = json.load(f)
+        return cls(vocab, data["offsets"], data["doc_ids"], data["impacts"], int(data["n_docs"]))
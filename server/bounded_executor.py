@@ -0,0 +1,109 @@
+"""
+Shared, bounded thread pool with admission control for blocking backends.
+
+At most `max_workers` jobs run at once and at most `max_queue` callers wait
+for a slot. Anyone beyond that is turned away immediately with
+503 + Retry-After, so clients back off instead of piling up and timing out.
+"""
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict
+
+from fastapi import HTTPException
+
+
+class BoundedExecutor:
+    def __init__(self, name: str, max_workers: int, max_queue: int, retry_after_s: int = 5):
+        self.name = name
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue = max(0, int(max_queue))
+        self.retry_after_s = max(1, int(retry_after_s))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self._slots = asyncio.Semaphore(self.max_workers)
+        # Metrics
+        self.waiting = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._wait_ms_total = 0.0
+        self._wait_ms_max = 0.0
+
+    def check_admission(self) -> None:
+        """Raise 503 + Retry-After if no slot is free and the wait queue is full."""
+        if self._slots.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail=f"{self.name} is busy ({self.in_flight} running, {self.waiting} queued); retry later.",
+                headers={"Retry-After": str(self.retry_after_s)},
+            )
+
+    async def _acquire(self) -> None:
+        self.check_admission()
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        wait_ms = (time.perf_counter() - started) * 1000.0
+        self.admitted += 1
+        self._wait_ms_total += wait_ms
+        self._wait_ms_max = max(self._wait_ms_max, wait_ms)
+        self.in_flight += 1
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._slots.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the max_workers slots, queueing (or rejecting) as needed."""
+        await self._acquire()
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Run a blocking call on the shared pool once a slot is free.
+
+        The slot is held until the call returns, not until the caller stops
+        waiting. A cancelled caller (client disconnect, retrieval deadline)
+        can't stop a running thread, and releasing early would let more than
+        max_workers calls run while admission counted fewer.
+        """
+        await self._acquire()
+        loop = asyncio.get_running_loop()
+        try:
+            future = self.executor.submit(functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            self._release()
+            raise
+
+        def done(_future) -> None:
+            try:
+                loop.call_soon_threadsafe(self._release)
+            except RuntimeError:  # loop already closed (shutdown)
+                pass
+
+        future.add_done_callback(done)
+        # Cancelling this await cancels a call that hasn't started; one that
+        # has keeps its slot until done() runs
+        return await asyncio.wrap_future(future, loop=loop)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "queued": self.waiting,
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait_ms": (self._wait_ms_total / self.admitted) if self.admitted else 0.0,
+            "max_wait_ms": self._wait_ms_max,
+        }
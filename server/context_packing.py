@@ -0,0 +1,157 @@
+"""
+Context packing for the /ask prompt.
+
+Retrieved contexts overlap: ingestion splits pages with 100-120 chars of
+overlap, and local notes often restate the book. Before the prompt is built:
+
+  1. adjacent chunks from the same page (or the same note) whose ends overlap
+     are merged into one passage, without repeating the overlap;
+  2. near-duplicates are dropped: word 5-gram shingle overlap >= threshold,
+     measured against the smaller shingle set so a note restating part of a
+     longer book chunk counts. The candidate sets are a handful of chunks, so
+     exact set overlap is cheaper than MinHash sketches would be;
+  3. what is left is packed in rank order into a token budget measured with
+     the LLM's tokenizer (ASK_TOKENIZER), or about chars/4 without one.
+
+Contexts are duck-typed: anything with .text, .source, .metadata, .note_id and
+pydantic's model_copy works.
+"""
+import re
+import threading
+from typing import Any, List, NamedTuple, Optional, Set, Tuple
+
+
+_WORD_RE = re.compile(r"\w+")
+
+
+class TokenCounter:
+    """Counts tokens with a Hugging Face tokenizer, falling back to ~4 chars per token."""
+
+    def __init__(self, tokenizer_name: Optional[str]):
+        self.tokenizer_name = tokenizer_name
+        self._tokenizer = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if not self._loaded:
+                self._loaded = True
+                if self.tokenizer_name:
+                    try:
+                        from transformers import AutoTokenizer
+
+                        self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+                    except Exception as e:
+                        print(f"[ask] Tokenizer {self.tokenizer_name!r} unavailable, estimating chars/4: {e}")
+        return self._tokenizer
+
+    @property
+    def exact(self) -> bool:
+        return self._load() is not None
+
+    def count(self, text: str) -> int:
+        tok = self._load()
+        if tok is None:
+            return (len(text) + 3) // 4
+        return len(tok.encode(text, add_special_tokens=False))
+
+
+def _shingles(text: str, n: int = 5) -> Set[Tuple[str, ...]]:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < n:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + n]) for i in range(len(words) - n + 1)}
+
+
+def _overlap_coefficient(a: Set, b: Set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def _overlap(left: str, right: str, min_chars: int, max_chars: int) -> int:
+    """Length of the longest suffix of left that is a prefix of right (0 if < min_chars)."""
+    for size in range(min(max_chars, len(left), len(right)), min_chars - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _same_passage(a: Any, b: Any) -> bool:
+    """Chunks that may be neighbours in the source: same note, or same book page."""
+    if a.source != b.source:
+        return False
+    if a.source == "local":
+        return a.note_id is not None and a.note_id == b.note_id
+    page_a = (a.metadata or {}).get("page_number")
+    page_b = (b.metadata or {}).get("page_number")
+    return page_a is not None and page_a == page_b and a.course_id == b.course_id
+
+
+class PackResult(NamedTuple):
+    contexts: List[Any]
+    tokens_before: int
+    tokens_after: int
+    merged: int
+    duplicates: int
+    over_budget: int
+
+
+def pack_contexts(
+    contexts: List[Any],
+    counter: TokenCounter,
+    token_budget: int,
+    dedupe_threshold: float = 0.8,
+    min_overlap_chars: int = 20,
+    max_overlap_chars: int = 300,
+) -> PackResult:
+    """Merge overlapping neighbours, drop near-duplicates, then fill token_budget in rank order."""
+    tokens_before = sum(counter.count(c.text) for c in contexts)
+
+    # 1. Merge: fold each chunk into an earlier (higher ranked) neighbour it overlaps
+    merged_ctxs: List[Any] = []
+    merged = 0
+    for ctx in contexts:
+        for i, kept in enumerate(merged_ctxs):
+            if not _same_passage(kept, ctx):
+                continue
+            n = _overlap(kept.text, ctx.text, min_overlap_chars, max_overlap_chars)
+            if n:
+                merged_ctxs[i] = kept.model_copy(update={"text": kept.text + ctx.text[n:]})
+                break
+            n = _overlap(ctx.text, kept.text, min_overlap_chars, max_overlap_chars)
+            if n:
+                merged_ctxs[i] = kept.model_copy(update={"text": ctx.text + kept.text[n:]})
+                break
+        else:
+            merged_ctxs.append(ctx)
+            continue
+        merged += 1
+
+    # 2. Dedupe: keep the higher ranked of any near-identical pair
+    unique: List[Any] = []
+    unique_shingles: List[Set] = []
+    duplicates = 0
+    for ctx in merged_ctxs:
+        sh = _shingles(ctx.text)
+        if any(_overlap_coefficient(sh, kept_sh) >= dedupe_threshold for kept_sh in unique_shingles):
+            duplicates += 1
+            continue
+        unique.append(ctx)
+        unique_shingles.append(sh)
+
+    # 3. Budget: skip what doesn't fit, so a smaller lower-ranked chunk still can.
+    # The top context is always kept, even if it alone exceeds the budget.
+    packed: List[Any] = []
+    used = 0
+    over_budget = 0
+    for ctx in unique:
+        cost = counter.count(ctx.text)
+        if packed and used + cost > token_budget:
+            over_budget += 1
+            continue
+        packed.append(ctx)
+        used += cost
+
+    return PackResult(packed, tokens_before, used, merged, duplicates, over_budget)
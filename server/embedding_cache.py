@@ -0,0 +1,230 @@
+"""
+Content-addressed cache for text embeddings.
+
+Entries are keyed by sha256(model id, normalized text), so the same note chunk
+sent by different requests (or after a restart) maps to the same vector.
+
+Two tiers:
+  - memory: an LRU bounded by entry count.
+  - disk (optional): fixed-size slot files memory-mapped with numpy. Slots are
+    reused oldest-first once the tier is full, and entries survive restarts.
+"""
+import hashlib
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+KEY_BYTES = 32  # sha256 digest
+
+
+def normalize_text(text: str) -> str:
+    """Unicode NFC + collapse runs of whitespace; the tokenizer ignores both."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(model_id: str, text: str) -> bytes:
+    h = hashlib.sha256()
+    h.update(model_id.encode("utf-8"))
+    h.update(b"\0")
+    h.update(normalize_text(text).encode("utf-8"))
+    return h.digest()
+
+
+def _open_memmap(path: str, dtype, shape):
+    """Map an existing file of the right size, or create a zeroed one. Returns (memmap, created)."""
+    expected = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    fresh = not os.path.exists(path) or os.path.getsize(path) != expected
+    return np.memmap(path, dtype=dtype, mode="w+" if fresh else "r+", shape=shape), fresh
+
+
+class _DiskTier:
+    """
+    Ring of `capacity` slots stored in three memory-mapped files:
+      keys.u8     (capacity, 32) uint8   — sha256 key per slot
+      seq.u64     (capacity,)    uint64  — write sequence, 0 = empty slot
+      vectors.f32 (capacity, dim) float32
+    The slot with the highest sequence number marks where writing resumes.
+    """
+
+    def __init__(self, directory: str, capacity: int, dim: int):
+        os.makedirs(directory, exist_ok=True)
+        self.capacity = capacity
+        self.dim = dim
+        self._keys, _ = _open_memmap(os.path.join(directory, "keys.u8"), np.uint8, (capacity, KEY_BYTES))
+        self._seq, _ = _open_memmap(os.path.join(directory, "seq.u64"), np.uint64, (capacity,))
+        self._vecs, fresh = _open_memmap(
+            os.path.join(directory, f"vectors-{dim}.f32"), np.float32, (capacity, dim)
+        )
+        if fresh:
+            # A new vector file (e.g. the dimension changed) invalidates old slots
+            self._seq[:] = 0
+
+        self._index: Dict[bytes, int] = {}
+        valid = np.nonzero(self._seq)[0]
+        for slot in valid:
+            self._index[self._keys[slot].tobytes()] = int(slot)
+        if len(valid):
+            last = int(valid[np.argmax(self._seq[valid])])
+            self._next_seq = int(self._seq[last]) + 1
+            self._cursor = (last + 1) % capacity
+        else:
+            self._next_seq = 1
+            self._cursor = 0
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        slot = self._index.get(key)
+        if slot is None:
+            return None
+        return np.array(self._vecs[slot], dtype=np.float32)
+
+    def put(self, key: bytes, vec: np.ndarray) -> bool:
+        """Store vec; returns True if an older entry was overwritten."""
+        if key in self._index:
+            return False
+        slot = self._cursor
+        evicted = False
+        if self._seq[slot]:
+            self._index.pop(self._keys[slot].tobytes(), None)
+            evicted = True
+        # Invalidate first so a torn write is never read back as a hit
+        self._seq[slot] = 0
+        self._keys[slot] = np.frombuffer(key, dtype=np.uint8)
+        self._vecs[slot] = vec
+        self._seq[slot] = self._next_seq
+        self._index[key] = slot
+        self._next_seq += 1
+        self._cursor = (slot + 1) % self.capacity
+        return evicted
+
+    def flush(self) -> None:
+        for mm in (self._keys, self._vecs, self._seq):
+            mm.flush()
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        model_id: str,
+        max_entries: int,
+        disk_dir: Optional[str] = None,
+        disk_entries: int = 0,
+    ):
+        self.model_id = model_id
+        self.max_entries = max(0, int(max_entries))
+        self.disk_dir = disk_dir
+        self.disk_entries = max(0, int(disk_entries))
+        self._mem: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._disk: Optional[_DiskTier] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+    def open(self, dim: int) -> None:
+        """Attach the disk tier once the model (and so the vector size) is known."""
+        if self.disk_dir and self.disk_entries > 0:
+            directory = os.path.join(self.disk_dir, self.model_id)
+            self._disk = _DiskTier(directory, self.disk_entries, dim)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._disk is not None:
+                self._disk.flush()
+                self._disk = None
+            self._mem.clear()
+
+    def key(self, text: str) -> bytes:
+        return cache_key(self.model_id, text)
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        with self._lock:
+            vec = self._mem.get(key)
+            if vec is not None:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return vec
+            if self._disk is not None:
+                vec = self._disk.get(key)
+                if vec is not None:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self._remember(key, vec)
+                    return vec
+            self.misses += 1
+            return None
+
+    def put(self, key: bytes, vec: np.ndarray) -> None:
+        vec = np.asarray(vec, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vec)
+            if self._disk is not None and self._disk.put(key, vec):
+                self.disk_evictions += 1
+
+    def _remember(self, key: bytes, vec: np.ndarray) -> None:
+        if self.max_entries == 0:
+            return
+        self._mem[key] = vec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._mem),
+            "max_entries": self.max_entries,
+            "disk_entries": len(self._disk) if self._disk is not None else 0,
+            "disk_capacity": self.disk_entries if self._disk is not None else 0,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_evictions": self.disk_evictions,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+def lookup_many(cache: EmbeddingCache, texts: List[str]):
+    """
+    Resolve texts against the cache.
+
+    Returns (vectors, misses): vectors has one entry per text (None for a miss)
+    and misses maps each distinct missing key to the positions that need it, so
+    repeated texts inside one batch are encoded only once.
+    """
+    vectors: List[Optional[np.ndarray]] = []
+    misses: "OrderedDict[bytes, List[int]]" = OrderedDict()
+    for i, text in enumerate(texts):
+        key = cache.key(text)
+        if key in misses:
+            misses[key].append(i)
+            vectors.append(None)
+            continue
+        vec = cache.get(key)
+        if vec is None:
+            misses[key] = [i]
+        vectors.append(vec)
+    return vectors, misses
+
+
+def fill_misses(cache: EmbeddingCache, vectors: List[Optional[np.ndarray]], misses, encoded) -> np.ndarray:
+    """Store freshly encoded vectors (one per miss key, in order) and stack the result."""
+    if not vectors:
+        return np.zeros((0, 0), dtype=np.float32)
+    encoded = np.asarray(encoded, dtype=np.float32)
+    for (key, positions), vec in zip(misses.items(), encoded):
+        cache.put(key, vec)
+        for i in positions:
+            vectors[i] = vec
+    return np.stack(vectors)
@@ -1,11 +1,15 @@
 import os
+import copy
+import asyncio
+import threading
 from contextlib import asynccontextmanager
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 
+import numpy as np
 import torch
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException
 from pydantic import BaseModel, Field
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 
 try:
     from dotenv import load_dotenv  # type: ignore
@@ -13,9 +17,18 @@ try:
 except Exception:
     pass
 
+try:
+    import msgpack  # type: ignore
+except Exception:
+    msgpack = None
+
 from sentence_transformers import SentenceTransformer
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from bounded_executor import BoundedExecutor
+from embedding_cache import EmbeddingCache, lookup_many, fill_misses
+from observability import SIZE_BUCKETS, histogram, install as install_observability
+
 
 # ----------------------------
 # Config / Globals
@@ -27,18 +40,109 @@ MODEL_PATH = os.getenv(
 )
 MODEL_NAME = os.path.basename(MODEL_PATH)
 
-_model: SentenceTransformer | None = None
+# Inference backend: "torch" (SentenceTransformer), or the exported ONNX graph
+# on onnxruntime CPU ("onnx", or "onnx-int8" for the dynamically quantized copy).
+BACKEND = os.getenv("EMB_BACKEND", "torch").strip().lower()
+ONNX_PATH = os.getenv("EMB_ONNX_PATH", os.path.join("models", "embedding-onnx"))
+ONNX_MAX_LENGTH = int(os.getenv("EMB_ONNX_MAX_LENGTH", "256"))  # all-MiniLM-L6-v2 max_seq_length
+ONNX_THREADS = int(os.getenv("EMB_ONNX_THREADS", "0"))  # 0 = onnxruntime default
+if BACKEND not in ("torch", "onnx", "onnx-int8"):
+    raise ValueError(f"EMB_BACKEND must be torch, onnx or onnx-int8 (got {BACKEND!r})")
+
+# Micro-batching for /embedding/embed: flush when either limit is reached.
+BATCH_MAX_SIZE = int(os.getenv("EMB_BATCH_MAX_SIZE", "32"))
+BATCH_MAX_WAIT_MS = float(os.getenv("EMB_BATCH_MAX_WAIT_MS", "5"))
+
+# Inference pool: every encode runs on a dedicated bounded executor, so the event
+# loop (and /embedding/health) stays free while a large batch is encoding.
+# EMB_INFER_WORKERS encodes run at once, EMB_INFER_MAX_QUEUE more may wait, and
+# the rest get 503 + Retry-After. EMB_TORCH_THREADS is torch's intra-op thread
+# count; 0 = available cores / workers, so workers don't oversubscribe the CPU.
+INFER_WORKERS = int(os.getenv("EMB_INFER_WORKERS", "2"))
+INFER_MAX_QUEUE = int(os.getenv("EMB_INFER_MAX_QUEUE", "64"))
+INFER_RETRY_AFTER = int(os.getenv("EMB_INFER_RETRY_AFTER", "2"))
+TORCH_THREADS = int(os.getenv("EMB_TORCH_THREADS", "0"))
+
+# Length bucketing for model.encode: inputs are sorted by token count and packed
+# into padded batches of at most this many (padded) tokens.
+MAX_BATCH_TOKENS = int(os.getenv("EMB_MAX_BATCH_TOKENS", "8192"))
+
+# Embedding cache: in-memory LRU, plus an on-disk tier when EMB_CACHE_DIR is set.
+CACHE_SIZE = int(os.getenv("EMB_CACHE_SIZE", "10000"))
+CACHE_DIR = os.getenv("EMB_CACHE_DIR") or None
+CACHE_DISK_ENTRIES = int(os.getenv("EMB_CACHE_DISK_ENTRIES", "200000"))
+
+_model = None  # SentenceTransformer, or OnnxEmbedder for the onnx backends
+_infer = BoundedExecutor("embedding-infer", INFER_WORKERS, INFER_MAX_QUEUE, INFER_RETRY_AFTER)
+# Backends agree to ~1e-3 cosine, not bit for bit, so their cached vectors are kept apart
+_cache = EmbeddingCache(
+    MODEL_NAME if BACKEND == "torch" else f"{MODEL_NAME}-{BACKEND}",
+    CACHE_SIZE, CACHE_DIR, CACHE_DISK_ENTRIES,
+)
+
+
+def _load_model():
+    if BACKEND == "torch":
+        print(f"[embedding] Loading model from: {MODEL_PATH} on device: {device}")
+        if device == "cpu":
+            torch.set_num_threads(_torch_threads())
+            print(f"[embedding] torch intra-op threads: {torch.get_num_threads()} x {_infer.max_workers} workers")
+        return SentenceTransformer(MODEL_PATH, device=device)
+    from onnx_embedder import OnnxEmbedder
+
+    print(f"[embedding] Loading {BACKEND} model from: {ONNX_PATH} (onnxruntime CPU)")
+    return OnnxEmbedder(
+        ONNX_PATH,
+        quantized=BACKEND == "onnx-int8",
+        max_length=ONNX_MAX_LENGTH,
+        num_threads=ONNX_THREADS,
+    )
+
+
+def preload() -> bool:
+    """
+    Load the model before prefork.py forks workers, so they share its weights
+    copy-on-write. ONNX sessions own thread pools that don't survive fork, so
+    the onnx backends still load once per worker.
+    """
+    global _model
+    if BACKEND != "torch":
+        print(f"[embedding] {BACKEND} backend: each worker loads its own session")
+        return False
+    _model = _load_model()
+    return True
+
+
+def prefork_worker(index: int, workers: int) -> None:
+    """Per-worker setup right after fork."""
+    if device == "cpu":
+        torch.set_num_threads(_torch_threads(workers))
+    # The disk tier is a single-writer ring, so each worker gets its own, sized
+    # so that all workers together stay within EMB_CACHE_DISK_ENTRIES
+    if _cache.disk_dir:
+        _cache.disk_dir = os.path.join(_cache.disk_dir, f"worker-{index}")
+        _cache.disk_entries //= workers
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global _model
     try:
-        print(f"[embedding] Loading model from: {MODEL_PATH} on device: {device}")
-        _model = SentenceTransformer(MODEL_PATH, device=device)
-        print("[embedding] Model ready.")
+        if _model is None:
+            _model = _load_model()
+        _cache.open(_model.get_sentence_embedding_dimension())
+        # Warm-up: the first encode fixes the tokenizer's padding/truncation
+        # state before worker threads share it (see _length_tokenizer)
+        _encode(["warm-up"])
+        _batcher.start()
+        print(
+            f"[embedding] Model ready (batch max_size={_batcher.max_batch_size}, "
+            f"max_wait={BATCH_MAX_WAIT_MS}ms)."
+        )
         yield
     finally:
+        await _batcher.stop()
+        _cache.close()
         _model = None
         if device == "cuda":
             torch.cuda.empty_cache()
@@ -46,6 +150,7 @@ async def lifespan(app: FastAPI):
 
 
 app = FastAPI(title="Embedding Service", lifespan=lifespan)
+install_observability(app, "embedding")
 
 
 # ----------------------------
@@ -68,7 +173,7 @@ class ChunkAndEmbedRequest(BaseModel):
 # ----------------------------
 # Helpers
 # ----------------------------
-def _require_model() -> SentenceTransformer:
+def _require_model():
     if _model is None:
         raise HTTPException(status_code=503, detail="Model not loaded yet.")
     return _model
@@ -102,65 +207,420 @@ def _to_float_list(vec) -> List[float]:
     return [float(x) for x in vec]
 
 
+class _PaddingStats:
+    """Real vs padded token counts across encode batches (updated from worker threads)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def add(self, lengths: List[int]) -> None:
+        with self._lock:
+            self.batches += 1
+            self.real_tokens += sum(lengths)
+            self.padded_tokens += max(lengths) * len(lengths)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_batch_tokens": MAX_BATCH_TOKENS,
+            "batches": self.batches,
+            "real_tokens": self.real_tokens,
+            "padded_tokens": self.padded_tokens,
+            "waste_ratio": (1.0 - self.real_tokens / self.padded_tokens) if self.padded_tokens else 0.0,
+        }
+
+
+_padding = _PaddingStats()
+# Length counting uses different truncation/padding settings than encode, and a
+# fast tokenizer that changes its settings while another thread encodes with it
+# fails with "Already borrowed". Each inference thread counts with its own copy,
+# so the shared tokenizer only ever runs encode's settings.
+_length_tokenizers = threading.local()
+
+ENCODE_SECONDS = histogram("embedding_encode_seconds", "Time per _encode call, all length buckets.")
+ENCODE_BATCH_TEXTS = histogram("embedding_encode_batch_texts", "Texts per _encode call.", buckets=SIZE_BUCKETS)
+
+
+def _torch_threads(processes: int = 1) -> int:
+    if TORCH_THREADS > 0:
+        return TORCH_THREADS
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    return max(1, cores // (processes * _infer.max_workers))
+
+
+def _length_tokenizer(model):
+    tok = getattr(_length_tokenizers, "tokenizer", None)
+    if tok is None or getattr(_length_tokenizers, "model", None) is not model:
+        tok = copy.deepcopy(model.tokenizer)
+        _length_tokenizers.tokenizer, _length_tokenizers.model = tok, model
+    return tok
+
+
+def _token_lengths(model, texts: List[str]) -> List[int]:
+    max_len = getattr(model, "max_seq_length", None) or 512
+    enc = _length_tokenizer(model)(texts, add_special_tokens=True, truncation=True, max_length=max_len)
+    return [len(ids) for ids in enc["input_ids"]]
+
+
+def _plan_buckets(lengths: List[int], max_tokens: int) -> List[List[int]]:
+    """
+    Indices sorted by length, split into batches whose padded size
+    (count * longest) stays within max_tokens. A single text longer than the
+    budget gets a batch of its own.
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    buckets: List[List[int]] = []
+    current: List[int] = []
+    for i in order:
+        # Sorted ascending, so the newcomer is the longest in the bucket
+        if current and (len(current) + 1) * lengths[i] > max_tokens:
+            buckets.append(current)
+            current = []
+        current.append(i)
+    if current:
+        buckets.append(current)
+    return buckets
+
+
+# Response formats for the batch endpoints, picked from the Accept header.
+# Raw formats are the row-major (count, dim) little-endian matrix with no
+# framing; X-Vector-Count / X-Vector-Dim headers carry the shape.
+FORMAT_JSON = "application/json"
+FORMAT_F32 = "application/x-float32"
+FORMAT_F16 = "application/x-float16"  # half the bytes, ~1e-3 relative error
+FORMAT_MSGPACK = "application/msgpack"
+_RAW_DTYPES = {FORMAT_F32: np.dtype("<f4"), FORMAT_F16: np.dtype("<f2")}
+
+
+def _negotiate_format(accept: Optional[str], allow_raw: bool = True) -> str:
+    """
+    Most preferred supported type in the client's Accept list; JSON when none
+    is named. Entries are ordered by q-value (ties keep their listed order) and
+    q=0 means "not acceptable", so `application/x-float32;q=0, application/json`
+    gets JSON.
+    """
+    ranked = []
+    for pos, part in enumerate((accept or "").split(",")):
+        media, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0  # malformed weight: ignore the entry
+        if q > 0:
+            ranked.append((-q, pos, media.lower()))
+    for _, _, media in sorted(ranked):
+        if media in (FORMAT_JSON, "*/*", "application/*", ""):
+            return FORMAT_JSON
+        if media in _RAW_DTYPES:
+            if not allow_raw:
+                raise HTTPException(
+                    status_code=406,
+                    detail=f"{media} has no room for chunk texts; use {FORMAT_MSGPACK} or {FORMAT_JSON}",
+                )
+            return media
+        if media in (FORMAT_MSGPACK, "application/x-msgpack"):
+            if msgpack is None:
+                raise HTTPException(status_code=406, detail="msgpack is not installed on this server")
+            return FORMAT_MSGPACK
+    return FORMAT_JSON
+
+
+def _vector_bytes(embs: np.ndarray, dtype: np.dtype) -> memoryview:
+    """Flat byte view of the (count, dim) matrix; no copy when it is already float32 C-order."""
+    arr = np.ascontiguousarray(embs, dtype=dtype)
+    return memoryview(arr.reshape(-1).view(np.uint8))
+
+
+def _binary_response(fmt: str, embs: np.ndarray, chunks: Optional[List[str]] = None) -> Response:
+    count, dim = (embs.shape if embs.ndim == 2 else (0, 0))
+    headers = {"X-Vector-Count": str(count), "X-Vector-Dim": str(dim), "X-Model": MODEL_NAME}
+    if fmt == FORMAT_MSGPACK:
+        payload: Dict[str, Any] = {
+            "vectors": _vector_bytes(embs, np.dtype("<f4")),
+            "dtype": "float32",
+            "dim": dim,
+            "count": count,
+            "model": MODEL_NAME,
+        }
+        if chunks is not None:
+            payload["chunks"] = chunks
+        return Response(content=msgpack.packb(payload, use_bin_type=True), media_type=fmt, headers=headers)
+    return Response(content=_vector_bytes(embs, _RAW_DTYPES[fmt]), media_type=fmt, headers=headers)
+
+
+def _encode(texts: List[str]) -> np.ndarray:
+    """
+    Blocking encode over a list of texts; run it on the _infer pool.
+
+    SentenceTransformer.encode only sorts by character length inside fixed
+    32-text batches, so a title and a 700-char chunk still share a padded
+    batch. Here texts are grouped by token length under a padded-token budget,
+    each group is one forward pass, and rows are put back in input order.
+    """
+    model = _require_model()
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    ENCODE_BATCH_TEXTS.observe(len(texts))
+    with ENCODE_SECONDS.time():
+        lengths = _token_lengths(model, texts)
+        out: Optional[np.ndarray] = None
+        for bucket in _plan_buckets(lengths, MAX_BATCH_TOKENS):
+            embs = model.encode(
+                [texts[i] for i in bucket],
+                batch_size=len(bucket),
+                convert_to_tensor=False,
+                device=device,
+                show_progress_bar=False,
+            )
+            embs = np.asarray(embs, dtype=np.float32)
+            if out is None:
+                out = np.empty((len(texts), embs.shape[1]), dtype=np.float32)
+            out[bucket] = embs
+            _padding.add([lengths[i] for i in bucket])
+    return out
+
+
+async def _embed_cached(texts: List[str]) -> np.ndarray:
+    """Vectors for texts as an (n, dim) float32 array; only cache misses reach the model."""
+    vectors, misses = lookup_many(_cache, texts)
+    encoded = []
+    if misses:
+        encoded = await _infer.run(_encode, [texts[pos[0]] for pos in misses.values()])
+    return fill_misses(_cache, vectors, misses, encoded)
+
+
+# ----------------------------
+# Micro-batching
+# ----------------------------
+class _EmbedBatcher:
+    """
+    Coalesces single-text requests into one model.encode call.
+
+    Requests are queued with their arrival time. A background task takes the
+    oldest request and keeps collecting until either max_batch_size texts are
+    queued or the oldest one has waited max_wait_ms, then encodes the whole
+    batch in a worker thread and resolves each caller's future with its vector.
+    Batches are encoded one at a time, so requests arriving during an encode
+    pile up and form the next (larger) batch.
+    """
+
+    def __init__(self, max_batch_size: int, max_wait_ms: float):
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # Metrics
+        self._requests = 0
+        self._batches = 0
+        self._batched_total = 0
+        self._batch_size_max = 0
+        self._wait_ms_total = 0.0
+        self._wait_ms_max = 0.0
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, _, fut = self._queue.get_nowait()
+                if not fut.done():
+                    fut.set_exception(HTTPException(status_code=503, detail="Embedding service shutting down."))
+            self._queue = None
+
+    async def submit(self, text: str) -> Tuple[np.ndarray, float, int]:
+        """Queue one text. Returns (vector, queue_wait_ms, batch_size)."""
+        if self._queue is None:
+            raise HTTPException(status_code=503, detail="Model not loaded yet.")
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._queue.put_nowait((text, loop.time(), fut))
+        return await fut
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        assert self._queue is not None
+        while True:
+            batch = [await self._queue.get()]
+            deadline = batch[0][1] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                try:
+                    if remaining <= 0:
+                        batch.append(self._queue.get_nowait())
+                    else:
+                        batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+            await self._flush(batch)
+
+    async def _flush(self, batch) -> None:
+        # Drop requests whose caller has already gone away
+        batch = [item for item in batch if not item[2].done()]
+        if not batch:
+            return
+        started = asyncio.get_running_loop().time()
+        try:
+            embs = await _infer.run(_encode, [text for text, _, _ in batch])
+        except Exception as e:
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        size = len(batch)
+        self._batches += 1
+        self._batched_total += size
+        self._batch_size_max = max(self._batch_size_max, size)
+        for (_, enqueued, fut), emb in zip(batch, embs):
+            wait_ms = (started - enqueued) * 1000.0
+            self._requests += 1
+            self._wait_ms_total += wait_ms
+            self._wait_ms_max = max(self._wait_ms_max, wait_ms)
+            if not fut.done():
+                fut.set_result((emb, wait_ms, size))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "requests": self._requests,
+            "batches": self._batches,
+            "avg_batch_size": (self._batched_total / self._batches) if self._batches else 0.0,
+            "max_batch_size_seen": self._batch_size_max,
+            "avg_queue_wait_ms": (self._wait_ms_total / self._requests) if self._requests else 0.0,
+            "max_queue_wait_ms": self._wait_ms_max,
+        }
+
+
+_batcher = _EmbedBatcher(BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+
+
 # ----------------------------
 # Routes
 # ----------------------------
 @app.get("/embedding/health")
 async def health() -> Dict[str, Any]:
-    return {"status": "ok", "device": device, "model": MODEL_NAME}
+    return {
+        "status": "ok",
+        "device": device if BACKEND == "torch" else "cpu",
+        "backend": BACKEND,
+        "model": MODEL_NAME,
+        "batcher": _batcher.stats(),
+        "cache": _cache.stats(),
+        "padding": _padding.stats(),
+        "inference": {**_infer.stats(), "torch_threads": torch.get_num_threads()},
+    }
 
 
 @app.post("/embedding/embed")
 async def embed(req: EmbedRequest) -> JSONResponse:
-    model = _require_model()
+    _require_model()
     if not req.text.strip():
         raise HTTPException(status_code=400, detail="text must be non-empty")
+    key = _cache.key(req.text)
+    cached = _cache.get(key)
+    if cached is not None:
+        vec = _to_float_list(cached)
+        return JSONResponse(
+            {"vector": vec, "dim": len(vec), "model": MODEL_NAME},
+            headers={"X-Cache": "hit"},
+        )
     try:
-        emb = model.encode(req.text, convert_to_tensor=False, device=device, show_progress_bar=False)
+        emb, wait_ms, batch_size = await _batcher.submit(req.text)
+        _cache.put(key, emb)
         vec = _to_float_list(emb)
-        return JSONResponse({"vector": vec, "dim": len(vec), "model": MODEL_NAME})
+        return JSONResponse(
+            {"vector": vec, "dim": len(vec), "model": MODEL_NAME},
+            headers={
+                "X-Cache": "miss",
+                "X-Queue-Wait-Ms": f"{wait_ms:.2f}",
+                "X-Batch-Size": str(batch_size),
+            },
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Embedding failed: {e}") from e
 
 
 @app.post("/embedding/embed-batch")
-async def embed_batch(req: EmbedBatchRequest) -> JSONResponse:
-    model = _require_model()
+async def embed_batch(req: EmbedBatchRequest, accept: Optional[str] = Header(None)) -> Response:
+    _require_model()
     texts = [t for t in req.texts if isinstance(t, str) and t.strip()]
     if not texts:
         raise HTTPException(status_code=400, detail="texts must contain at least one non-empty string")
+    fmt = _negotiate_format(accept)
     try:
-        embs = model.encode(texts, convert_to_tensor=False, device=device, show_progress_bar=False)
+        embs = await _embed_cached(texts)
+        if fmt != FORMAT_JSON:
+            return _binary_response(fmt, embs)
         out = [_to_float_list(e) for e in embs]
         dim = len(out[0]) if out else 0
         return JSONResponse({"vectors": out, "dim": dim, "count": len(out), "model": MODEL_NAME})
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Batch embedding failed: {e}") from e
 
 
 @app.post("/embedding/chunk-and-embed")
-async def chunk_and_embed(req: ChunkAndEmbedRequest) -> JSONResponse:
-    model = _require_model()
+async def chunk_and_embed(req: ChunkAndEmbedRequest, accept: Optional[str] = Header(None)) -> Response:
+    _require_model()
     text = req.text or ""
     if not text.strip():
         raise HTTPException(status_code=400, detail="text must be non-empty")
+    fmt = _negotiate_format(accept, allow_raw=False)
     chunks = _chunk_text(text, req.chunk_size, req.chunk_overlap)
     try:
-        embs = model.encode(chunks, convert_to_tensor=False, device=device, show_progress_bar=False)
+        embs = await _embed_cached(chunks)
+        if fmt != FORMAT_JSON:
+            return _binary_response(fmt, embs, chunks)
         out = [{"chunk_text": c, "vector": _to_float_list(e)} for c, e in zip(chunks, embs)]
         dim = len(out[0]["vector"]) if out else 0
         return JSONResponse({"embeddings": out, "dim": dim, "count": len(out), "model": MODEL_NAME})
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Chunk+embed failed: {e}") from e
 
 
+async def _embed_texts(texts: List[str]) -> List[List[float]]:
+    """Batch embed function for the in-process /ask routes: one model.encode(list) call."""
+    embs = await _embed_cached(list(texts))
+    return [_to_float_list(e) for e in embs]
+
+
 # Register /ask routes
-def _embed_text(text: str) -> List[float]:
-    """Helper function to embed text using the loaded model."""
-    model = _require_model()
-    emb = model.encode(text, convert_to_tensor=False, device=device, show_progress_bar=False)
-    return _to_float_list(emb)
+# In-process mode: serve /ask from this process instead of the standalone ask service
+if os.getenv("EMB_SERVE_ASK", "0") == "1":
+    try:
+        from ask_service import register_ask_routes
+    except ImportError as e:
+        raise RuntimeError(
+            f"EMB_SERVE_ASK=1 needs the ask service's requirements as well ({e}); "
+            "install langchain-ollama or run ask_service.py on its own"
+        ) from e
 
+    register_ask_routes(app, _embed_texts)
 
 
 
@@ -169,6 +629,14 @@ if __name__ == "__main__":
 
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("EMB_PORT", "8001"))
-    uvicorn.run("embedding_service:app", host=host, port=port, reload=True)
+    workers = int(os.getenv("EMB_WORKERS", "1"))
+    if workers > 1:
+        # Pre-fork: load the model once, then fork workers that share its pages
+        from prefork import serve
+
+        serve("embedding_service", host, port, workers)
+    else:
+        # Auto-reload is for development only: EMB_RELOAD=1
+        uvicorn.run("embedding_service:app", host=host, port=port, reload=os.getenv("EMB_RELOAD", "0") == "1")
 
 
@@ -1,7 +1,13 @@
 import io
 import re  # <-- 1. ADDED IMPORT
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
 from contextlib import asynccontextmanager
 import os
+from typing import Dict, List, Optional
 try:
     from dotenv import load_dotenv  # type: ignore
     load_dotenv()
@@ -14,32 +20,96 @@ from fastapi.responses import HTMLResponse, Response
 from PIL import Image
 from transformers import AutoProcessor, AutoModelForVision2Seq
 
+from observability import SIZE_BUCKETS, histogram, install as install_observability
+from ocr_cache import OcrCache
+
+# Per-request detail (raw model output, upload names, block counts) is logged at
+# DEBUG; /metrics carries the timings
+logger = logging.getLogger("studysync.ocr")
+
 # --- Global Variables for Model ---
 processor = None
 model = None
 device = "cuda" if torch.cuda.is_available() else "cpu"
 # Use bfloat16 for performance if available, otherwise float32
 model_dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
-
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+OCR_MODEL_PATH = os.getenv("OCR_MODEL_PATH", "./models/ocr")
+
+# --- Batched OCR settings ---
+# "auto" sizes each generate() batch from free memory; an integer pins it.
+OCR_BATCH_SIZE = os.getenv("OCR_BATCH_SIZE", "auto")
+OCR_MEM_PER_IMAGE_MB = float(os.getenv("OCR_MEM_PER_IMAGE_MB", "1024"))
+OCR_MAX_BATCH_SIZE = int(os.getenv("OCR_MAX_BATCH_SIZE", "8"))
+OCR_BATCH_MAX_FILES = int(os.getenv("OCR_BATCH_MAX_FILES", "32"))
+
+# --- Async OCR job settings ---
+OCR_JOB_WORKERS = int(os.getenv("OCR_JOB_WORKERS", "1"))
+OCR_JOB_MAX_QUEUE = int(os.getenv("OCR_JOB_MAX_QUEUE", "64"))
+OCR_JOB_TTL_S = float(os.getenv("OCR_JOB_TTL_S", "600"))
+OCR_JOB_MAX_WAIT_S = float(os.getenv("OCR_JOB_MAX_WAIT_S", "60"))
+
+# --- OCR result cache (set OCR_CACHE_DIR="" to disable) ---
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", os.path.join("cache", "ocr"))
+OCR_CACHE_MAX_MB = float(os.getenv("OCR_CACHE_MAX_MB", "256"))
+# Max dHash bit distance for near-duplicate hits; unset = exact pixels only
+OCR_CACHE_PHASH_DISTANCE = os.getenv("OCR_CACHE_PHASH_DISTANCE")
+ocr_cache: Optional[OcrCache] = None
+
+def load_model():
     """
-    Asynchronous context manager to load the model on startup
-    and free it on shutdown.
+    Load the processor and model into the module globals. Called from the
+    lifespan, or once before fork by prefork.py so workers share the weights.
+    The OCR cache is not opened here: its LRU index and byte count live in one
+    process, so each worker opens its own in the lifespan (see prefork_worker).
     """
     global processor, model
     print(f"--- Loading model on device: {device} with dtype: {model_dtype} ---")
 
-    local_model_path = "./models/ocr"
+    local_model_path = OCR_MODEL_PATH
     processor = AutoProcessor.from_pretrained(local_model_path)
     # 2. UPDATED MODEL LOADING WITH DTYPE
     model = AutoModelForVision2Seq.from_pretrained(
         local_model_path,
         torch_dtype=model_dtype
     ).to(device)
+    model.eval()
 
     print("--- Model loading complete ---")
+
+
+def prefork_worker(index: int, workers: int) -> None:
+    """
+    Per-worker setup right after fork (prefork.py). Nothing coordinates OCR
+    cache eviction across processes, so workers sharing one directory would
+    each fill it to OCR_CACHE_MAX_MB. Each worker gets its own subdirectory and
+    1/workers of the cap instead; the total stays within the cap, but an image
+    only hits in the worker that cached it.
+    """
+    global OCR_CACHE_DIR, OCR_CACHE_MAX_MB
+    if OCR_CACHE_DIR:
+        OCR_CACHE_DIR = os.path.join(OCR_CACHE_DIR, f"worker-{index}")
+        OCR_CACHE_MAX_MB = OCR_CACHE_MAX_MB / workers
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Asynchronous context manager to load the model on startup
+    and free it on shutdown.
+    """
+    global processor, model, ocr_cache
+    if model is None:
+        load_model()
+    if OCR_CACHE_DIR:
+        ocr_cache = OcrCache(
+            OCR_CACHE_DIR,
+            int(OCR_CACHE_MAX_MB * 1024 * 1024),
+            int(OCR_CACHE_PHASH_DISTANCE) if OCR_CACHE_PHASH_DISTANCE else None,
+        )
+        print(f"--- OCR cache at {OCR_CACHE_DIR}: {ocr_cache.stats()['entries']} entries ---")
+    _ocr_jobs.start()
     yield
+    await _ocr_jobs.stop()
     print("--- Shutting down and cleaning up model ---")
     del model
     del processor
@@ -48,6 +118,10 @@ async def lifespan(app: FastAPI):
 
 # Create the FastAPI app with the lifespan event handler
 app = FastAPI(lifespan=lifespan)
+install_observability(app, "ocr")
+
+OCR_STAGE_SECONDS = histogram("ocr_stage_seconds", "Time per run_kosmos_ocr_batch stage, per chunk of images.", ("stage",))
+OCR_BATCH_IMAGES = histogram("ocr_batch_images", "Images per model.generate call.", buckets=SIZE_BUCKETS)
 
 # 3. ADDED POST_PROCESS FUNCTION (MODIFIED FROM YOUR EXAMPLE)
 def post_process_ocr(generated_text: str, prompt: str, scale_height: float, scale_width: float):
@@ -123,6 +197,28 @@ def post_process_ocr(generated_text: str, prompt: str, scale_height: float, scal
     return blocks
 
 
+def _ocr_batch_size() -> int:
+    """How many images to push through one model.generate call."""
+    if OCR_BATCH_SIZE != "auto":
+        return max(1, int(OCR_BATCH_SIZE))
+    per_image = OCR_MEM_PER_IMAGE_MB * 1024 * 1024
+    try:
+        if device == "cuda":
+            free, _ = torch.cuda.mem_get_info()
+        else:
+            free = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError, RuntimeError):
+        return 1
+    return max(1, min(OCR_MAX_BATCH_SIZE, int(free // per_image)))
+
+
+def _as_list(values) -> list:
+    # Processor returns height/width as a tensor (one entry per image) or a list
+    if hasattr(values, "flatten"):
+        return values.flatten().tolist()
+    return [float(v) for v in values]
+
+
 # 4. COMPLETELY REWRITTEN KOSMOS FUNCTION
 def run_kosmos_ocr(image: Image.Image):
     """
@@ -130,63 +226,248 @@ def run_kosmos_ocr(image: Image.Image):
     We run this in a threadpool to avoid blocking the main server thread.
     Uses the correct <ocr> prompt and processing.
     """
-    try:
-        prompt = "<ocr>"
-        raw_width, raw_height = image.size
-
-        # Process the image and prompt
-        inputs = processor(text=prompt, images=image, return_tensors="pt")
-
-        # Get scaling factors
-        # .item() converts the 0-dim tensor to a plain Python number
-        height = inputs.pop("height").item()
-        width = inputs.pop("width").item()
-
-        scale_height = raw_height / height
-        scale_width = raw_width / width
+    return run_kosmos_ocr_batch([image])[0]
 
-        # Move inputs to the correct device
-        inputs = {k: v.to(device) if v is not None else None for k, v in inputs.items()}
-        # Ensure flattened_patches has the correct dtype
-        inputs["flattened_patches"] = inputs["flattened_patches"].to(model_dtype)
 
-        # Generate the output
-        generated_ids = model.generate(
-            **inputs,
-            max_new_tokens=1024,
-            use_cache=True
-        )
-
-        # Decode the generated text
-        generated_text = processor.batch_decode(
-            generated_ids,
-            skip_special_tokens=True
-        )[0]
-
-        print(f"--- RAW MODEL OUTPUT: '{generated_text}' ---")
+def run_kosmos_ocr_batch(images: List[Image.Image]) -> List[list]:
+    """
+    Batched version of run_kosmos_ocr: returns one list of blocks per image.
 
-        # Use the new post-processing function
-        blocks = post_process_ocr(
-            generated_text,
-            prompt,
-            scale_height,
-            scale_width
-        )
-        return blocks
+    The processor handles each chunk of images in one call (flattened patches
+    are padded to the same size) and model.generate runs on the whole chunk.
+    Every image uses the same <ocr> prompt, so the text inputs need no extra
+    padding. Chunk size comes from _ocr_batch_size(). Each image's blocks are
+    scaled back with its own height/width factors.
+    """
+    try:
+        prompt = "<ocr>"
+        batch_size = _ocr_batch_size()
+        results: List[list] = []
+
+        for start in range(0, len(images), batch_size):
+            chunk = images[start:start + batch_size]
+
+            OCR_BATCH_IMAGES.observe(len(chunk))
+            with OCR_STAGE_SECONDS.time(stage="preprocess"):
+                # Process the images and prompts
+                inputs = processor(text=[prompt] * len(chunk), images=chunk, return_tensors="pt")
+
+                # Get scaling factors (one per image)
+                heights = _as_list(inputs.pop("height"))
+                widths = _as_list(inputs.pop("width"))
+
+                # Move inputs to the correct device
+                inputs = {k: v.to(device) if v is not None else None for k, v in inputs.items()}
+                # Ensure flattened_patches has the correct dtype
+                inputs["flattened_patches"] = inputs["flattened_patches"].to(model_dtype)
+
+            with OCR_STAGE_SECONDS.time(stage="generate"):
+                # Generate the output
+                generated_ids = model.generate(
+                    **inputs,
+                    max_new_tokens=1024,
+                    use_cache=True
+                )
+
+            with OCR_STAGE_SECONDS.time(stage="postprocess"):
+                # Decode the generated text
+                generated_texts = processor.batch_decode(
+                    generated_ids,
+                    skip_special_tokens=True
+                )
+
+                for image, generated_text, height, width in zip(chunk, generated_texts, heights, widths):
+                    logger.debug("raw model output: %r", generated_text)
+                    raw_width, raw_height = image.size
+                    # Use the new post-processing function
+                    results.append(
+                        post_process_ocr(
+                            generated_text,
+                            prompt,
+                            raw_height / height,
+                            raw_width / width
+                        )
+                    )
+        return results
 
     except Exception as e:
         print(f"Error during model inference: {e}")
         raise e
 
+def run_cached_ocr(image: Image.Image):
+    """run_kosmos_ocr behind the result cache. Returns (blocks, cache_hit)."""
+    if ocr_cache is None:
+        return run_kosmos_ocr(image), False
+    fp = ocr_cache.fingerprint(image)
+    blocks = ocr_cache.get(fp)
+    if blocks is not None:
+        return blocks, True
+    blocks = run_kosmos_ocr(image)
+    ocr_cache.put(fp, blocks)
+    return blocks, False
+
+
+def run_cached_ocr_batch(images: List[Image.Image]) -> List[list]:
+    """run_kosmos_ocr_batch behind the result cache; only misses reach the model."""
+    if ocr_cache is None:
+        return run_kosmos_ocr_batch(images)
+    fps = [ocr_cache.fingerprint(image) for image in images]
+    results: List[Optional[list]] = [ocr_cache.get(fp) for fp in fps]
+    misses = [i for i, blocks in enumerate(results) if blocks is None]
+    if misses:
+        fresh = run_kosmos_ocr_batch([images[i] for i in misses])
+        for i, blocks in zip(misses, fresh):
+            ocr_cache.put(fps[i], blocks)
+            results[i] = blocks
+    return results
+
+
+# --- ASYNC OCR JOBS ---
+class _OcrJob:
+    def __init__(self, digest: str, image: Image.Image):
+        self.id = uuid.uuid4().hex
+        self.digest = digest
+        self.image: Optional[Image.Image] = image
+        self.status = "queued"  # queued -> running -> done | failed
+        self.blocks: Optional[list] = None
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.done = asyncio.Event()
+
+    def to_dict(self) -> dict:
+        out = {"job_id": self.id, "status": self.status, "created": self.created}
+        if self.started is not None:
+            out["queue_wait_s"] = round(self.started - self.created, 3)
+        if self.finished is not None and self.started is not None:
+            out["run_s"] = round(self.finished - self.started, 3)
+        if self.status == "done":
+            out["blocks"] = self.blocks
+        elif self.status == "failed":
+            out["error"] = self.error
+        return out
+
+
+class _OcrJobQueue:
+    """
+    Accepts OCR work without holding the HTTP connection open.
+
+    A fixed number of worker tasks drain a bounded queue into run_kosmos_ocr.
+    Finished jobs are kept for OCR_JOB_TTL_S seconds; a janitor task purges
+    expired ones even when no requests come in. A submission whose image
+    bytes match a live (queued, running or done) job attaches to that job
+    instead of running the model again; failed jobs are not reused so a client
+    can retry.
+    """
+
+    def __init__(self, workers: int, max_queue: int, ttl_s: float):
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.ttl_s = ttl_s
+        self._jobs: Dict[str, _OcrJob] = {}
+        self._by_digest: Dict[str, str] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.deduplicated = 0
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._janitor()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def submit(self, image_bytes: bytes, image: Image.Image):
+        """Returns (job, deduplicated)."""
+        self._purge()
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        existing = self._jobs.get(self._by_digest.get(digest, ""))
+        if existing is not None and existing.status != "failed":
+            self.deduplicated += 1
+            return existing, True
+        if self._queue is None:
+            raise HTTPException(status_code=503, detail="OCR model not loaded yet.")
+        job = _OcrJob(digest, image)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise HTTPException(
+                status_code=503,
+                detail="OCR job queue is full; retry later.",
+                headers={"Retry-After": "10"},
+            )
+        self._jobs[job.id] = job
+        self._by_digest[digest] = job.id
+        return job, False
+
+    def get(self, job_id: str) -> Optional[_OcrJob]:
+        self._purge()
+        return self._jobs.get(job_id)
+
+    def _purge(self):
+        cutoff = time.time() - self.ttl_s
+        expired = [j for j in self._jobs.values() if j.finished is not None and j.finished < cutoff]
+        for job in expired:
+            del self._jobs[job.id]
+            if self._by_digest.get(job.digest) == job.id:
+                del self._by_digest[job.digest]
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.started = time.time()
+            try:
+                job.blocks, _ = await run_in_threadpool(run_cached_ocr, job.image)
+                job.status = "done"
+                logger.debug("ocr job %s: %d blocks", job.id, len(job.blocks))
+            except Exception as e:
+                print(f"OCR JOB {job.id} failed: {e}")
+                job.error = str(e)
+                job.status = "failed"
+            finally:
+                job.image = None
+                job.finished = time.time()
+                job.done.set()
+            self._purge()
+
+    async def _janitor(self):
+        # Expired results are otherwise only dropped by submit/get, i.e. never while idle
+        interval = min(60.0, max(1.0, self.ttl_s / 2))
+        while True:
+            await asyncio.sleep(interval)
+            self._purge()
+
+    def stats(self) -> dict:
+        counts: Dict[str, int] = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "jobs": counts,
+            "deduplicated": self.deduplicated,
+        }
+
+
+_ocr_jobs = _OcrJobQueue(OCR_JOB_WORKERS, OCR_JOB_MAX_QUEUE, OCR_JOB_TTL_S)
+
+
 @app.post("/ocr")
-async def ocr_endpoint(file: UploadFile = File(...)):
+async def ocr_endpoint(response: Response, file: UploadFile = File(...)):
     """
     The main API endpoint that your Flutter app will call.
     It accepts a multipart form upload with a key named 'file'.
     """
-    print(f"--- RECEIVED FILE: {file.filename}, CONTENT_TYPE: {file.content_type} ---")
+    logger.debug("received file %s (%s)", file.filename, file.content_type)
     if not file.content_type.startswith("image/"):
-        print(f"--- REJECTED: Content type is not 'image/' ---")
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
 
     try:
@@ -208,8 +489,9 @@ async def ocr_endpoint(file: UploadFile = File(...)):
     try:
         # Run the blocking OCR function in a non-blocking way
         # 5. REMOVED THE "prompt" ARGUMENT AS IT'S NOW HARDCODED
-        blocks = await run_in_threadpool(run_kosmos_ocr, pil_image)
-        print(f"OCR BLOCKS: {len(blocks)}")
+        blocks, cache_hit = await run_in_threadpool(run_cached_ocr, pil_image)
+        response.headers["X-OCR-Cache"] = "hit" if cache_hit else "miss"
+        logger.debug("ocr blocks: %d", len(blocks))
         return {"blocks": blocks}
 
     except Exception as e:
@@ -217,6 +499,95 @@ async def ocr_endpoint(file: UploadFile = File(...)):
         print(f"Internal server error: {e}")
         raise HTTPException(status_code=500, detail=f"An error occurred during OCR processing: {e}")
 
+@app.post("/ocr/batch")
+async def ocr_batch_endpoint(files: List[UploadFile] = File(...)):
+    """
+    Multi-image variant of /ocr: a multipart upload with several 'file' parts.
+    Returns {"results": [{"filename": ..., "blocks": [...]}, ...]} in upload order.
+    """
+    logger.debug("received batch of %d files", len(files))
+    if not files:
+        raise HTTPException(status_code=400, detail="No files uploaded.")
+    if len(files) > OCR_BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many files: {len(files)} (max {OCR_BATCH_MAX_FILES}).",
+        )
+
+    images = []
+    for file in files:
+        if not (file.content_type or "").startswith("image/"):
+            raise HTTPException(status_code=400, detail=f"Invalid file type for {file.filename}. Please upload images.")
+        try:
+            image_bytes = await file.read()
+            images.append(Image.open(io.BytesIO(image_bytes)).convert("RGB"))
+        except Exception as e:
+            print(f"Error reading image {file.filename}: {e}")
+            raise HTTPException(status_code=400, detail=f"Could not read image file {file.filename}: {e}")
+
+    try:
+        blocks_per_image = await run_in_threadpool(run_cached_ocr_batch, images)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("ocr batch blocks: %s", [len(b) for b in blocks_per_image])
+        return {
+            "results": [
+                {"filename": file.filename, "blocks": blocks}
+                for file, blocks in zip(files, blocks_per_image)
+            ]
+        }
+
+    except Exception as e:
+        print(f"Internal server error: {e}")
+        raise HTTPException(status_code=500, detail=f"An error occurred during OCR processing: {e}")
+
+@app.post("/ocr/jobs", status_code=202)
+async def create_ocr_job(file: UploadFile = File(...)):
+    """
+    Queue an image for OCR and return a job ID straight away.
+    Poll GET /ocr/jobs/{job_id} (optionally with ?wait=seconds) for the result.
+    """
+    logger.debug("received job file %s (%s)", file.filename, file.content_type)
+    if not (file.content_type or "").startswith("image/"):
+        raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
+    try:
+        image_bytes = await file.read()
+        pil_image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    except Exception as e:
+        print(f"Error reading image: {e}")
+        raise HTTPException(status_code=400, detail=f"Could not read image file: {e}")
+
+    job, deduplicated = _ocr_jobs.submit(image_bytes, pil_image)
+    return {"job_id": job.id, "status": job.status, "deduplicated": deduplicated}
+
+
+@app.get("/ocr/jobs/{job_id}")
+async def get_ocr_job(job_id: str, wait: float = 0.0):
+    """
+    Job status, plus blocks once done. With wait > 0 the request blocks until
+    the job finishes or `wait` seconds pass (capped at OCR_JOB_MAX_WAIT_S).
+    """
+    job = _ocr_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job ID.")
+    wait = min(max(0.0, wait), OCR_JOB_MAX_WAIT_S)
+    if wait > 0 and not job.done.is_set():
+        try:
+            await asyncio.wait_for(job.done.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+    return job.to_dict()
+
+
+@app.get("/ocr/health")
+async def ocr_health():
+    return {
+        "status": "ok",
+        "device": device,
+        "model_loaded": model is not None,
+        "jobs": _ocr_jobs.stats(),
+        "cache": ocr_cache.stats() if ocr_cache is not None else None,
+    }
+
 # --- TEST ENDPOINT ---
 @app.get("/test", response_class=HTMLResponse)
 async def get_test_page():
@@ -308,4 +679,12 @@ if __name__ == "__main__":
     import uvicorn
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run("main:app", host=host, port=port, reload=True)
+    workers = int(os.getenv("OCR_WORKERS", "1"))
+    if workers > 1:
+        # Pre-fork: load the model once, then fork workers that share its pages
+        from prefork import serve
+
+        serve("main", host, port, workers)
+    else:
+        # Auto-reload is for development only: OCR_RELOAD=1
+        uvicorn.run("main:app", host=host, port=port, reload=os.getenv("OCR_RELOAD", "0") == "1")
@@ -0,0 +1,207 @@
+"""
+Metrics and request IDs shared by the OCR, embedding and ask services.
+
+Metrics are rendered in the Prometheus text format (version 0.0.4) on
+GET /metrics; no client library is needed to scrape them:
+
+  http_request_duration_seconds{service,method,route,status}   every request
+  ocr_stage_seconds{stage}          preprocess / generate / postprocess
+  ocr_batch_images                  images per model.generate call
+  embedding_encode_seconds          one _encode call (all its length buckets)
+  embedding_encode_batch_texts      texts per _encode call
+  ask_stage_seconds{stage}          embed, supabase, local scoring, pack,
+                                    prompt, llm, ... (the Server-Timing stages)
+
+Request IDs: an incoming X-Request-ID is kept, otherwise one is generated.
+It is echoed on the response and available to the handler through
+current_request_id(), so outgoing calls (ask -> embedding) can forward it and
+one question can be followed across services. OBS_LOG_REQUESTS=1 prints one
+line per request with the ID, route, status and duration.
+
+Call install(app, "<service>") once per FastAPI app. Metrics live in a
+process-wide registry, so when the ask routes are served inside the embedding
+service they show up on that service's /metrics.
+"""
+import bisect
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+
+
+REQUEST_ID_HEADER = "X-Request-ID"
+LOG_REQUESTS = os.getenv("OBS_LOG_REQUESTS", "0") == "1"
+
+# Seconds; covers sub-millisecond scoring up to minute-long OCR/LLM calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+_request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+
+def current_request_id() -> Optional[str]:
+    """The X-Request-ID of the request being handled, if any."""
+    return _request_id.get()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (per-bucket counts incl. +Inf, sum, count)
+        self._series: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._series[key] = series
+            series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(k, list(s[0]), s[1], s[2]) for k, s in sorted(self._series.items())]
+        for key, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = _labels(self.labelnames, key, f'le="{_fmt(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_fmt(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class _Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        # Get-or-create, so modules that are imported by several services share one series
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = Histogram(name, help_text, labelnames, buckets)
+                self._metrics[name] = metric
+            return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for m in metrics for line in m.render()) + "\n"
+
+
+REGISTRY = _Registry()
+histogram = REGISTRY.histogram
+
+HTTP_REQUEST_SECONDS = histogram(
+    "http_request_duration_seconds",
+    "Time from request start to the last response byte.",
+    ("service", "method", "route", "status"),
+)
+
+
+class _RequestMiddleware:
+    """
+    Pure ASGI middleware: sets the request ID, echoes it, and times the whole
+    response (streaming bodies included, unlike a BaseHTTPMiddleware).
+    """
+
+    def __init__(self, app, service: str):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = None
+        for name, value in scope.get("headers", ()):
+            if name == b"x-request-id":
+                incoming = value.decode("latin-1")[:128]
+                break
+        rid = incoming or uuid.uuid4().hex
+        token = _request_id.set(rid)
+        status = {"code": 500}
+        t0 = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((REQUEST_ID_HEADER.lower().encode(), rid.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - t0
+            _request_id.reset(token)
+            # The matched route template keeps the label set small (no raw job ids)
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            if route != "/metrics":
+                HTTP_REQUEST_SECONDS.observe(
+                    elapsed,
+                    service=self.service,
+                    method=scope.get("method", ""),
+                    route=route,
+                    status=str(status["code"]),
+                )
+            if LOG_REQUESTS:
+                print(
+                    f"[{self.service}] rid={rid} {scope.get('method')} {scope.get('path')} "
+                    f"{status['code']} {elapsed * 1000.0:.1f}ms"
+                )
+
+
+def install(app: FastAPI, service: str) -> None:
+    """Add the request-ID/timing middleware and GET /metrics to an app."""
+    app.add_middleware(_RequestMiddleware, service=service)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics() -> PlainTextResponse:
+        return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,178 @@
+"""
+On-disk cache of post-processed OCR blocks.
+
+Entries are keyed by sha256 of the decoded RGB pixels (plus image size), so the
+same photo re-sent after a Drive sync or from the debug page hits the cache even
+if the upload's file name or metadata changed.
+
+With a perceptual-hash distance configured, a miss on the exact key falls back
+to a near-duplicate lookup: a 64-bit difference hash (dHash) within that many
+bits of a cached image of the *same pixel size* counts as a hit. The size must
+match because block coordinates are in the original image's pixel space.
+
+Each entry is one JSON file. The store is bounded by total bytes and evicts the
+least recently used files; file mtimes are bumped on access so the LRU order
+survives restarts.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+
+
+class ImageFingerprint(NamedTuple):
+    key: str
+    phash: int
+    size: Tuple[int, int]
+
+
+def _dhash(image: Image.Image) -> int:
+    """64-bit difference hash: compare horizontally adjacent pixels of a 9x8 thumbnail."""
+    small = image.convert("L").resize((9, 8), Image.BILINEAR)
+    px = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return bits
+
+
+class _Entry(NamedTuple):
+    nbytes: int
+    phash: int
+    size: Tuple[int, int]
+
+
+class OcrCache:
+    def __init__(self, directory: str, max_bytes: int, phash_distance: Optional[int] = None):
+        self.directory = directory
+        self.max_bytes = max(0, int(max_bytes))
+        self.phash_distance = phash_distance
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load_index(self) -> None:
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                st = os.stat(path)
+            except (OSError, ValueError):
+                continue
+            entry = _Entry(st.st_size, int(meta.get("phash", 0)), tuple(meta.get("size", (0, 0))))
+            found.append((st.st_mtime, name[:-5], entry))
+        for _, key, entry in sorted(found):
+            self._entries[key] = entry
+            self._bytes += entry.nbytes
+        self._evict()
+
+    def fingerprint(self, image: Image.Image) -> ImageFingerprint:
+        rgb = image if image.mode == "RGB" else image.convert("RGB")
+        h = hashlib.sha256()
+        h.update(f"{rgb.width}x{rgb.height}:".encode("ascii"))
+        h.update(rgb.tobytes())
+        phash = _dhash(rgb) if self.phash_distance is not None else 0
+        return ImageFingerprint(h.hexdigest(), phash, rgb.size)
+
+    def get(self, fp: ImageFingerprint) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            key = fp.key if fp.key in self._entries else None
+            near = False
+            if key is None and self.phash_distance is not None:
+                key = self._nearest(fp)
+                near = key is not None
+            if key is None:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    blocks = json.load(f)["blocks"]
+                os.utime(self._path(key))
+            except (OSError, ValueError, KeyError):
+                self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if near:
+                self.near_hits += 1
+            return blocks
+
+    def _nearest(self, fp: ImageFingerprint) -> Optional[str]:
+        best_key, best_dist = None, self.phash_distance + 1
+        for key, entry in self._entries.items():
+            if entry.size != fp.size:
+                continue
+            dist = (entry.phash ^ fp.phash).bit_count()
+            if dist < best_dist:
+                best_key, best_dist = key, dist
+        return best_key
+
+    def put(self, fp: ImageFingerprint, blocks: List[Dict[str, Any]]) -> None:
+        payload = json.dumps(
+            {"blocks": blocks, "phash": fp.phash, "size": list(fp.size), "created": time.time()}
+        )
+        path = self._path(fp.key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self._lock:
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(payload)
+                os.replace(tmp, path)
+            except OSError as e:
+                print(f"[ocr-cache] Failed to write {path}: {e}")
+                return
+            if fp.key in self._entries:
+                self._bytes -= self._entries.pop(fp.key).nbytes
+            entry = _Entry(os.path.getsize(path), fp.phash, fp.size)
+            self._entries[fp.key] = entry
+            self._bytes += entry.nbytes
+            self._evict()
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.nbytes
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        while self._entries and self._bytes > self.max_bytes:
+            key = next(iter(self._entries))
+            self._drop(key)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "phash_distance": self.phash_distance,
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
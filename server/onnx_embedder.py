@@ -0,0 +1,82 @@
+"""
+ONNX Runtime (CPU) drop-in for SentenceTransformer.encode.
+
+Runs the graph written by scripts/export_minilm_onnx.py (input_ids,
+attention_mask -> last_hidden_state) and applies the pooling contract from the
+export README in numpy: attention-masked mean pooling, then L2 normalization.
+
+The export directory holds model.onnx (and model.int8.onnx with --quantize)
+next to the tokenizer files saved by save_pretrained.
+"""
+import os
+from typing import List, Optional
+
+import numpy as np
+import onnxruntime as ort
+from transformers import AutoTokenizer
+
+
+class OnnxEmbedder:
+    def __init__(
+        self,
+        model_dir: str,
+        quantized: bool = False,
+        max_length: int = 256,
+        num_threads: int = 0,
+    ):
+        self.model_path = os.path.join(model_dir, "model.int8.onnx" if quantized else "model.onnx")
+        if not os.path.isfile(self.model_path):
+            raise FileNotFoundError(
+                f"{self.model_path} not found; run scripts/export_minilm_onnx.py"
+                + (" --quantize" if quantized else "")
+            )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        # Never exceed what the position embeddings cover
+        self.max_length = min(max_length, self.tokenizer.model_max_length)
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            opts.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            self.model_path, sess_options=opts, providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        self._dim: Optional[int] = None
+
+    @property
+    def max_seq_length(self) -> int:
+        return self.max_length
+
+    def get_sentence_embedding_dimension(self) -> int:
+        if self._dim is None:
+            self._dim = int(self.encode(["dimension probe"]).shape[1])
+        return self._dim
+
+    def _forward(self, texts: List[str]) -> np.ndarray:
+        enc = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="np",
+        )
+        feeds = {k: v.astype(np.int64) for k, v in enc.items() if k in self._input_names}
+        hidden = self.session.run(["last_hidden_state"], feeds)[0]
+        # Mean pooling over real tokens, then L2 normalize (README contract steps 4-5)
+        mask = enc["attention_mask"].astype(np.float32)[:, :, None]
+        summed = (hidden * mask).sum(axis=1)
+        pooled = summed / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return (pooled / np.clip(norms, 1e-12, None)).astype(np.float32)
+
+    def encode(self, texts, batch_size: int = 32, **_ignored) -> np.ndarray:
+        """
+        Same call shape as SentenceTransformer.encode for the options the
+        service uses; device/convert_to_tensor/show_progress_bar are ignored.
+        """
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        out = [self._forward(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)]
+        embs = np.concatenate(out) if out else np.zeros((0, 0), dtype=np.float32)
+        return embs[0] if single else embs
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Pre-fork serving for the model services: load the weights once, then fork
+workers that share them.
+
+  python prefork.py embedding --workers 4 --port 8001
+  python prefork.py ocr --workers 2 --port 8000
+
+(or EMB_WORKERS / OCR_WORKERS > 1 with `python embedding_service.py` /
+`python main.py`, which call serve()).
+
+The parent imports the service module and calls its preload(). It then
+binds the listening socket and gc.freeze()s everything allocated so far, so
+the collector never writes to those objects. Then it forks. Each child runs
+its own uvicorn server and event loop on the inherited socket, and the kernel
+spreads connections across them. Tensor storage is plain anonymous memory
+that the workers only read, so it stays shared copy-on-write. N workers
+cost one copy of the weights plus each worker's activations and caches.
+
+Per worker, after fork: torch gets cores // workers intra-op threads, then
+the module's prefork_worker(index, workers) hook runs if it has one. The
+lifespan then runs as usual and skips loading when the model is already
+present. Per-process state stays per worker: in-memory caches, the
+micro-batcher, admission queues and /metrics. A scrape sees one worker. Disk
+caches are split the same way: each worker gets a worker-<index>
+subdirectory and 1/workers of the configured size.
+
+The parent restarts workers that die and forwards SIGTERM/SIGINT for a
+graceful shutdown. CUDA contexts do not survive fork, so this refuses to run
+on a GPU; run one process per GPU there instead.
+"""
+import argparse
+import gc
+import importlib
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Dict, Optional
+
+import uvicorn
+
+
+SERVICES = {"embedding": "embedding_service", "ocr": "main"}
+RESPAWN_DELAY_S = 1.0
+
+
+def _cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _bind(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(module, index: int, workers: int, sock: socket.socket, log_level: str) -> None:
+    """Child side of the fork; never returns."""
+    code = 0
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        import torch
+
+        torch.set_num_threads(max(1, _cores() // workers))
+        hook = getattr(module, "prefork_worker", None)
+        if hook is not None:
+            hook(index, workers)
+        print(f"[prefork] worker {index} pid={os.getpid()}")
+        config = uvicorn.Config(module.app, log_level=log_level, lifespan="on")
+        uvicorn.Server(config).run(sockets=[sock])
+    except BaseException as e:  # the child must not fall back into the parent's loop
+        print(f"[prefork] worker {index} failed: {e}")
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def serve(
+    module_name: str,
+    host: str,
+    port: int,
+    workers: int,
+    preload: bool = True,
+    log_level: str = "info",
+) -> int:
+    module = importlib.import_module(module_name)
+    if getattr(module, "device", "cpu") == "cuda":
+        raise SystemExit(
+            "[prefork] CUDA is not fork-safe; run one process per GPU instead of --workers."
+        )
+    # embedding_service.preload / main.load_model
+    loader = getattr(module, "preload", None) or getattr(module, "load_model", None)
+    if preload and loader is not None:
+        t0 = time.perf_counter()
+        loader()
+        print(f"[prefork] Preloaded {module_name} in {time.perf_counter() - t0:.1f}s")
+
+    sock = _bind(host, port)
+    # Everything so far (model objects included) moves to the permanent
+    # generation: the collector won't touch, and so won't copy, those pages
+    gc.collect()
+    gc.freeze()
+
+    children: Dict[int, int] = {}  # pid -> worker index
+    stopping = False
+
+    def spawn(index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(module, index, workers, sock, log_level)
+        children[pid] = index
+
+    def stop(signum, _frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"[prefork] Serving {module_name} on {host}:{port} with {workers} workers (parent pid={os.getpid()})")
+    for index in range(workers):
+        spawn(index)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index: Optional[int] = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        print(f"[prefork] worker {index} (pid {pid}) exited with status {status}; restarting")
+        time.sleep(RESPAWN_DELAY_S)
+        if not stopping:
+            spawn(index)
+    sock.close()
+    print("[prefork] All workers stopped.")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("service", choices=sorted(SERVICES), help="Which service to serve")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=None, help="Default: 8001 embedding, 8000 ocr")
+    parser.add_argument("--no-preload", action="store_true", help="Each worker loads its own copy (for comparison)")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    port = args.port if args.port is not None else (8001 if args.service == "embedding" else 8000)
+    return serve(
+        SERVICES[args.service],
+        args.host,
+        port,
+        max(1, args.workers),
+        preload=not args.no_preload,
+        log_level=args.log_level,
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
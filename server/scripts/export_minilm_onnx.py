@@ -6,11 +6,17 @@ Outputs (default: ../../app/assets/onnx/minilm/):
   - model.onnx   — AutoModel forward (input_ids, attention_mask) -> last_hidden_state
   - vocab.txt    — WordPiece vocabulary (same as bert-base-uncased)
   - README.md    — tokenizer + pooling contract
+  - model.int8.onnx — with --quantize: dynamic INT8 weights (onnxruntime
+                      quantize_dynamic) for the server's EMB_BACKEND=onnx-int8
+
+For the embedding service, export next to its models instead:
+  python scripts/export_minilm_onnx.py -o models/embedding-onnx --quantize
 
 Pooling is NOT in the graph: the app must apply mean pooling + L2 normalize
 to match SentenceTransformer.encode (sentence-transformers).
 
-Requires: torch, transformers, onnx (pip install torch transformers onnx).
+Requires: torch, transformers, onnx (pip install torch transformers onnx);
+--quantize also needs onnxruntime.
 Run from repo root or server/:  python scripts/export_minilm_onnx.py
 """
 from __future__ import annotations
@@ -52,13 +58,23 @@ def main() -> int:
         ),
         help="Output directory for model.onnx and vocab.txt",
     )
+    parser.add_argument(
+        "--model",
+        default=MODEL_ID,
+        help="Hugging Face id or local path of the model to export",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Also write model.int8.onnx with dynamically quantized INT8 weights",
+    )
     args = parser.parse_args()
     out_dir = os.path.abspath(args.out_dir)
     os.makedirs(out_dir, exist_ok=True)
 
-    print(f"[export] Loading {MODEL_ID} ...")
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
-    base = AutoModel.from_pretrained(MODEL_ID)
+    print(f"[export] Loading {args.model} ...")
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    base = AutoModel.from_pretrained(args.model)
     base.eval()
     wrapped = MiniLMOnnxWrapper(base)
     wrapped.eval()
@@ -108,6 +124,14 @@ def main() -> int:
         os.remove(data_sidecar)
     # save_pretrained writes vocab.txt, tokenizer_config.json, etc.
 
+    if args.quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        int8_path = os.path.join(out_dir, "model.int8.onnx")
+        print(f"[export] Writing {int8_path} ...")
+        # Weights-only INT8 (activations quantized on the fly): no calibration set needed
+        quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QInt8)
+
     readme = os.path.join(out_dir, "README.md")
     with open(readme, "w", encoding="utf-8") as f:
         f.write(
@@ -125,12 +149,17 @@ def main() -> int:
 Chunking for indexing uses the same character splitter as `server/embedding_service.py`
 (RecursiveCharacterTextSplitter: chunk_size=700, chunk_overlap=120, same separators).
 
+`model.int8.onnx` (from `--quantize`) has the same inputs, output and contract with
+dynamically quantized INT8 weights.
+
 Re-export after changing transformers version if vectors drift.
 """
         )
 
     print(f"[export] Done. Files in: {out_dir}")
     print("  - model.onnx")
+    if args.quantize:
+        print("  - model.int8.onnx")
     print("  - vocab.txt (and tokenizer JSON from save_pretrained)")
     return 0
 
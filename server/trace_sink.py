@@ -0,0 +1,122 @@
+"""
+Sampled /ask traces (question, timings, prompt, answer) off the request path.
+
+A sampled trace goes to two places:
+  - an in-memory ring buffer of the last ring_size traces (the debug endpoint
+    reads it);
+  - a JSON-lines file through a logging QueueHandler. A QueueListener thread
+    serializes and writes with a RotatingFileHandler, so the event loop only
+    pays for a queue put and concurrent requests never share an open file.
+    Each line is one JSON object.
+
+sample_rate is the fraction of requests kept (0 disables tracing, 1 keeps
+every request). An empty path keeps the ring buffer only.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+
+class _JsonLineFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, ensure_ascii=False, default=str)
+
+
+class _TraceQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stock prepare() formats the record and replaces msg with str(msg),
+        # turning the trace dict into its repr; keep the dict for the listener
+        return record
+
+
+class TraceSink:
+    def __init__(
+        self,
+        path: Optional[str],
+        sample_rate: float,
+        ring_size: int = 100,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 3,
+    ):
+        self.path = path or None
+        self.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+        self.max_bytes = int(max_bytes)
+        self.backup_count = int(backup_count)
+        self._ring: deque = deque(maxlen=max(1, int(ring_size)))
+        self._ring_lock = threading.Lock()
+        self._logger: Optional[logging.Logger] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self.seen = 0
+        self.sampled = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def start(self) -> None:
+        """Start the background file writer (no-op without a path or when already running)."""
+        if self._listener is not None or not self.path or not self.enabled:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            self.path, maxBytes=self.max_bytes, backupCount=self.backup_count, encoding="utf-8"
+        )
+        file_handler.setFormatter(_JsonLineFormatter())
+        records: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+        logger = logging.getLogger(f"studysync.traces.{id(self)}")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(_TraceQueueHandler(records))
+        self._listener = logging.handlers.QueueListener(records, file_handler)
+        self._listener.start()
+        self._logger = logger
+
+    def stop(self) -> None:
+        """Flush queued traces and close the file."""
+        if self._listener is None:
+            return
+        self._listener.stop()
+        for handler in list(self._logger.handlers) + list(self._listener.handlers):
+            handler.close()
+        self._logger.handlers.clear()
+        self._listener = None
+        self._logger = None
+
+    def should_sample(self) -> bool:
+        """One decision per request; call before building an expensive trace."""
+        self.seen += 1
+        if not self.enabled or random.random() >= self.sample_rate:
+            return False
+        self.sampled += 1
+        return True
+
+    def record(self, trace: Dict[str, Any]) -> None:
+        with self._ring_lock:
+            self._ring.append(trace)
+        if self._logger is not None:
+            self._logger.info(trace)
+
+    def recent(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Newest first."""
+        with self._ring_lock:
+            items = list(self._ring)
+        return items[::-1][: max(0, limit)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "path": self.path,
+            "writer_running": self._listener is not None,
+            "ring_size": self._ring.maxlen,
+            "buffered": len(self._ring),
+            "seen": self.seen,
+            "sampled": self.sampled,
+        }
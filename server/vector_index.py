@@ -0,0 +1,243 @@
+"""
+Embedded vector index over course-book chunks: a local stand-in for the
+Supabase pgvector match RPC.
+
+An index directory holds:
+  index.json      — dim, count, ivf_lists
+  vectors.npy     — (count, dim) float32, L2-normalized; memory-mapped on load
+  course_ids.npy  — (count,) int64, -1 when a row has no course
+  rows.jsonl      — chunk_text / course_id / metadata per row, same order
+  ivf.npz         — optional: centroids (lists, dim) + offsets (lists + 1)
+  bm25.npz, bm25_vocab.json — BM25 postings over chunk_text (see bm25.py)
+
+Rows are stored grouped by IVF list, so each list is one contiguous slice of
+vectors.npy. Search is exact (one matrix-vector product over the course's
+rows) unless the index was built with IVF lists; then only the nprobe
+closest lists are scanned.
+
+Build from an ingestion export (misc/embed-book.py --export, or a JSON/CSV
+export of the course_book_embedding table):
+
+  python vector_index.py build --rows book.jsonl --out indexes/books
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from bm25 import BM25Index
+
+
+IVF_AUTO_MIN_ROWS = 20000  # below this, exact search is already sub-millisecond
+
+
+def _normalize(mat: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(mat, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
+
+
+def _parse_vector(value: Any) -> List[float]:
+    # pgvector columns export as "[0.1,0.2,...]"
+    if isinstance(value, str):
+        value = json.loads(value)
+    return [float(x) for x in value]
+
+
+def _parse_metadata(value: Any) -> Optional[Dict[str, Any]]:
+    if isinstance(value, str) and value:
+        value = json.loads(value)
+    return value if isinstance(value, dict) else None
+
+
+def iter_export_rows(path: str) -> Iterator[Dict[str, Any]]:
+    """Rows shaped like course_book_embedding from .jsonl, .json (array) or .csv."""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            rows: Any = csv.DictReader(f)
+        elif path.endswith(".json"):
+            rows = json.load(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            course_id = row.get("course_id")
+            yield {
+                "chunk_text": str(row.get("chunk_text") or ""),
+                "course_id": int(course_id) if course_id not in (None, "") else None,
+                "metadata": _parse_metadata(row.get("metadata")),
+                "vector": _parse_vector(row["vector_data"]),
+            }
+
+
+def _assign(x: np.ndarray, centroids: np.ndarray, block: int = 8192) -> np.ndarray:
+    out = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), block):
+        out[start:start + block] = np.argmax(x[start:start + block] @ centroids.T, axis=1)
+    return out
+
+
+def spherical_kmeans(x: np.ndarray, k: int, iters: int = 20, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """k-means on the unit sphere (cosine). Returns (centroids, assignment)."""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    assign = _assign(x, centroids)
+    for _ in range(iters):
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        if empty.any():
+            # Re-seed empty lists from random points
+            sums[empty] = x[rng.choice(len(x), size=int(empty.sum()), replace=False)]
+        centroids = _normalize(sums)
+        new_assign = _assign(x, centroids)
+        if np.array_equal(new_assign, assign):
+            break
+        assign = new_assign
+    return centroids, assign
+
+
+def build_index(rows_path: str, out_dir: str, ivf_lists: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Build an index directory from an export file. ivf_lists=None picks
+    sqrt(count) lists for large exports and none for small ones; 0 disables IVF.
+    """
+    rows = list(iter_export_rows(rows_path))
+    if not rows:
+        raise ValueError(f"{rows_path} has no rows")
+    vectors = _normalize(np.asarray([r.pop("vector") for r in rows], dtype=np.float32))
+    n, dim = vectors.shape
+    if ivf_lists is None:
+        ivf_lists = int(np.sqrt(n)) if n >= IVF_AUTO_MIN_ROWS else 0
+    ivf_lists = min(ivf_lists, n)
+
+    order = np.arange(n)
+    centroids = offsets = None
+    if ivf_lists > 0:
+        centroids, assign = spherical_kmeans(vectors, ivf_lists)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=ivf_lists))])
+
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, "vectors.npy"), vectors[order])
+    course_ids = np.array([-1 if r["course_id"] is None else r["course_id"] for r in rows], dtype=np.int64)
+    np.save(os.path.join(out_dir, "course_ids.npy"), course_ids[order])
+    with open(os.path.join(out_dir, "rows.jsonl"), "w", encoding="utf-8") as f:
+        for i in order:
+            f.write(json.dumps(rows[i], ensure_ascii=False) + "\n")
+    # Term statistics are computed here, once, not per query
+    BM25Index.build([rows[i]["chunk_text"] for i in order]).save(out_dir)
+    ivf_path = os.path.join(out_dir, "ivf.npz")
+    if centroids is not None:
+        np.savez(ivf_path, centroids=centroids.astype(np.float32), offsets=offsets.astype(np.int64))
+    elif os.path.exists(ivf_path):
+        os.remove(ivf_path)
+    info = {"dim": int(dim), "count": int(n), "ivf_lists": int(ivf_lists)}
+    with open(os.path.join(out_dir, "index.json"), "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    return info
+
+
+class VectorIndex:
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "index.json"), "r", encoding="utf-8") as f:
+            self.info = json.load(f)
+        self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        self.course_ids = np.load(os.path.join(directory, "course_ids.npy"))
+        with open(os.path.join(directory, "rows.jsonl"), "r", encoding="utf-8") as f:
+            self.rows: List[Dict[str, Any]] = [json.loads(line) for line in f]
+        self.centroids: Optional[np.ndarray] = None
+        self.offsets: Optional[np.ndarray] = None
+        ivf_path = os.path.join(directory, "ivf.npz")
+        if os.path.exists(ivf_path):
+            data = np.load(ivf_path)
+            self.centroids, self.offsets = data["centroids"], data["offsets"]
+        self.bm25 = BM25Index.load(directory)
+        self._course_rows: Dict[int, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def dim(self) -> int:
+        return int(self.info["dim"])
+
+    def _rows_for_course(self, course_id: int) -> np.ndarray:
+        rows = self._course_rows.get(course_id)
+        if rows is None:
+            rows = np.flatnonzero(self.course_ids == course_id)
+            self._course_rows[course_id] = rows
+        return rows
+
+    def _candidates(self, q: np.ndarray, course_id: Optional[int], nprobe: int, exact: bool) -> Optional[np.ndarray]:
+        """Row ids to score, or None for every row."""
+        if self.centroids is None or exact:
+            return self._rows_for_course(course_id) if course_id is not None else None
+        nprobe = max(1, min(nprobe, len(self.centroids)))
+        probe = np.argpartition(-(self.centroids @ q), nprobe - 1)[:nprobe]
+        rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in probe])
+        if course_id is not None:
+            rows = rows[self.course_ids[rows] == course_id]
+        return rows
+
+    def search(
+        self,
+        query: Any,
+        k: int,
+        course_id: Optional[int] = None,
+        nprobe: int = 8,
+        exact: bool = False,
+    ) -> List[Tuple[int, float]]:
+        """Top-k (row id, cosine) pairs, best first."""
+        q = _normalize(np.asarray(query, dtype=np.float32).ravel())
+        if q.shape[0] != self.dim or k <= 0:
+            return []
+        rows = self._candidates(q, course_id, nprobe, exact)
+        mat = self.vectors if rows is None else self.vectors[rows]
+        if len(mat) == 0:
+            return []
+        scores = np.asarray(mat @ q)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        ids = top if rows is None else rows[top]
+        return [(int(i), float(s)) for i, s in zip(ids, scores[top])]
+
+
+    def keyword_search(self, query: str, k: int, course_id: Optional[int] = None) -> List[Tuple[int, float]]:
+        """Top-k (row id, BM25 score); empty for indexes built without BM25."""
+        if self.bm25 is None:
+            return []
+        rows = self._rows_for_course(course_id) if course_id is not None else None
+        return self.bm25.search(query, k, rows=rows)
+
+    def cosine(self, row_ids: List[int], query: Any) -> np.ndarray:
+        q = _normalize(np.asarray(query, dtype=np.float32).ravel())
+        return np.asarray(self.vectors[np.asarray(row_ids, dtype=np.int64)] @ q)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    build = sub.add_parser("build", help="Build an index directory from an ingestion export")
+    build.add_argument("--rows", required=True, help="Export file (.jsonl, .json or .csv)")
+    build.add_argument("--out", required=True, help="Index directory to write")
+    build.add_argument(
+        "--ivf-lists",
+        type=int,
+        default=None,
+        help=f"IVF list count; 0 = exact only (default: sqrt(count) from {IVF_AUTO_MIN_ROWS} rows up)",
+    )
+    args = parser.parse_args()
+    info = build_index(args.rows, args.out, args.ivf_lists)
+    print(f"[vector-index] Wrote {args.out}: {info}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())